@@ -0,0 +1,143 @@
+"""
+Benchmarks every measure over synthetic populations of increasing size.
+
+For each scale, a dataset is generated with `util.synthetic` (and reused on later runs),
+then loading, each population stage of each runner and writing the output are timed in a
+fresh process, so the reported peak memory belongs to that scale alone. Each runner
+starts without the shared indexes of the previous ones, so it pays for everything it
+builds. Stage throughput is the resources that stage itself scanned (see
+`util.instrument`) per second, next to the runner's stage cache hits and misses.
+
+    python benchmark.py --patients 1000 10000 100000 > ../bench_output.txt
+"""
+
+import argparse
+import json
+import multiprocessing
+import resource
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from os import path
+from typing import Any
+
+import main
+from deliverables import ALL_RUNNERS
+from util.loader import get_required_fields, load_ndjson_file, ndjson_path
+from util.runner import STAGES
+from util.sharding import build_runner, drop_resource_indexes
+from util.synthetic import RESOURCE_TYPES, generate_dataset
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is reported in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _timed(records: int, seconds: float) -> dict[str, float]:
+    return {
+        "seconds": round(seconds, 4),
+        "records": records,
+        "records_per_sec": round(records / seconds) if seconds else 0,
+    }
+
+
+def benchmark_data_dir(data_dir: str) -> dict[str, Any]:
+    """
+    Times loading, every stage of every runner, and output for one data directory
+    """
+    res: dict[str, Any] = {"load": {}, "runners": {}}
+    fields = get_required_fields(ALL_RUNNERS)
+    resources = {}
+    for resource_type, fl in fields.items():
+        t = time.perf_counter()
+        resources[resource_type] = load_ndjson_file(
+            ndjson_path(data_dir, resource_type), fl
+        )
+        res["load"][resource_type] = _timed(
+            len(resources[resource_type]), time.perf_counter() - t
+        )
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        for runner_class in ALL_RUNNERS:
+            # Indexes shared between runners would otherwise be billed to the first
+            drop_resource_indexes(resources)
+            runner = build_runner(
+                runner_class,
+                main.MEASUREMENT_PERIOD_START_DATETIME,
+                main.MEASUREMENT_PERIOD_END_DATETIME,
+                resources,
+            )
+            runner.enable_instrumentation()
+            timings: dict[str, Any] = {}
+            # Stages run in `run_all` order; dependencies are already cached by then
+            results = {}
+            for stage in STAGES:
+                t = time.perf_counter()
+                results[stage] = getattr(runner, stage)()
+                seconds = time.perf_counter() - t
+                metrics = runner.stage_metrics.get(stage, {})
+                timings[stage] = _timed(metrics.get("resources_scanned", 0), seconds)
+            t = time.perf_counter()
+            runner.report(results, save_to_dir=output_dir)
+            timings["output"] = _timed(
+                sum(len(v) for v in results.values() if v), time.perf_counter() - t
+            )
+            timings["total_seconds"] = round(
+                sum(v["seconds"] for v in timings.values()), 4
+            )
+            timings["stage_cache"] = runner.stage_stats
+            res["runners"][runner_class.__name__] = timings
+    res["peak_rss_mb"] = round(_peak_rss_mb(), 1)
+    return res
+
+
+def print_report(num_patients: int, res: dict[str, Any]) -> None:
+    print(f"📈 {num_patients} patients (peak RSS {res['peak_rss_mb']} MB)")
+    for resource_type, timing in res["load"].items():
+        print(
+            f"\tload {resource_type}: {timing['records']} records in "
+            f"{timing['seconds']}s ({timing['records_per_sec']}/s)"
+        )
+    for runner_name, timings in res["runners"].items():
+        print(f"\t{runner_name}: {timings['total_seconds']}s")
+        for stage in (*STAGES, "output"):
+            timing = timings[stage]
+            line = (
+                f"\t\t{stage}: {timing['seconds']}s, {timing['records']} records"
+                f" ({timing['records_per_sec']}/s)"
+            )
+            if stage in timings["stage_cache"]:
+                stats = timings["stage_cache"][stage]
+                line += f", cache {stats['hits']} hits / {stats['misses']} misses"
+            print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--patients", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--work-dir",
+        default=f"{tempfile.gettempdir()}/cqm-benchmark",
+        help="Where generated datasets are kept between runs",
+    )
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    all_results = {}
+    for num_patients in args.patients:
+        data_dir = f"{args.work_dir}/{num_patients}-seed{args.seed}"
+        if not all(path.exists(ndjson_path(data_dir, t)) for t in RESOURCE_TYPES):
+            print(f"🧬 Generating {num_patients} patients into {data_dir}")
+            generate_dataset(data_dir, num_patients, seed=args.seed)
+        with ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context("spawn")
+        ) as pool:
+            res = pool.submit(benchmark_data_dir, data_dir).result()
+        print_report(num_patients, res)
+        all_results[num_patients] = res
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(all_results, file, indent=2)
@@ -1,3 +1,12 @@
+from util.runner import BaseRunner
+
 from .cms125v11 import CMS125v11Runner
 from .cms147v11 import CMS147v11Runner
 from .cms165v11 import CMS165v11Runner
+
+# Every measure, in the order main.py runs them
+ALL_RUNNERS: list[type[BaseRunner]] = [
+    CMS125v11Runner,
+    CMS147v11Runner,
+    CMS165v11Runner,
+]
@@ -1,15 +1,21 @@
 from datetime import datetime
-from typing import Any
+from typing import AbstractSet, Any
 
 import arrow
-from util.helpers import (
-    date_is_within_date_range,
-    get_datediff_in_years,
-    get_reference_id_from_resource,
-    get_resource_sublist,
-    nested_get,
-)
-from util.runner import BaseRunner
+from util.columns import get_columns
+from util.dates import to_epoch_seconds
+from util.helpers import compile_path
+from util.instrument import count
+from util.patients import Gender, Patient, get_patient_table
+from util.populations import population_of_ids, population_of_rows
+from util.runner import BaseRunner, MeasureScan, ResourceHandler
+from util.static import MAMMOGRAPHY
+from util.store import ResourceStore, age_between, gender_is, has_resource
+from util.terminology import value_set_mask
+from util.timeline import PatientTimelines, get_timeline
+
+PERIOD_START = compile_path("period.start")
+PERFORMED_START = compile_path("performedPeriod.start")
 
 
 class CMS125v11Runner(BaseRunner):
@@ -21,57 +27,69 @@ class CMS125v11Runner(BaseRunner):
     Each function docstring will specify additional exceptions + cases to focus on for the purpose of this lab.
     """
 
+    RESOURCE_FIELDS = {
+        "Patient": ("id", "gender", "birthDate"),
+        "Encounter": ("subject.reference", "period.start"),
+        "Procedure": (
+            "subject.reference",
+            "performedPeriod.start",
+            "status",
+            "code.coding",
+        ),
+    }
+
     def __init__(
         self,
         start_period: datetime,
         end_period: datetime,
-        patient_list: list[dict[str, Any]],
-        encounter_list: list[dict[str, Any]],
-        procedure_list: list[dict[str, Any]],
+        patient_list: list[dict[str, Any]] | None = None,
+        encounter_list: list[dict[str, Any]] | None = None,
+        procedure_list: list[dict[str, Any]] | None = None,
+        store: ResourceStore | None = None,
     ):
         """
-        Use the provided lists
+        Use the provided lists, or query `store` (see `util.store`) instead
         """
         super().__init__(start_period, end_period)
-        self.patient_list = patient_list
-        self.encounter_list = encounter_list
-        self.procedure_list = procedure_list
+        if store is None and None in (patient_list, encounter_list, procedure_list):
+            raise ValueError("Pass every resource list, or a store")
+        # Left empty in store mode, where the stages query `store` instead
+        self.patient_list = [] if patient_list is None else patient_list
+        self.encounter_list = [] if encounter_list is None else encounter_list
+        self.procedure_list = [] if procedure_list is None else procedure_list
+        self.store = store
 
-    def initial_population(self) -> set[str]:
+    def initial_population(self) -> AbstractSet[str]:
         """
         Criteria:
         - Patient's gender is Female
         - Patient's calculated age at end period is between (52, 74)
         - Patient has at least 1 Encounter within the measurement period
         """
-        res = set()
-        for patient in self.patient_list:
-            if patient.get("gender") == "female":
-                birthdate = patient.get("birthDate")
-                age = get_datediff_in_years(birthdate, self.end_period)
-                if 52.0 <= age <= 74.0:
-                    pid = patient.get("id")
-                    # There are more efficient ways to do this, though this is the simplest
-                    encounter_list = get_resource_sublist(self.encounter_list, {pid})
-
-                    if (
-                        len(
-                            [
-                                e
-                                for e in encounter_list
-                                if date_is_within_date_range(
-                                    nested_get(e, "period.start"),
-                                    self.start_period,
-                                    self.end_period,
-                                )
-                            ]
-                        )
-                        > 0
-                    ):
-                        res.add(pid)
-        return res
-
-    def denominator(self) -> set[str]:
+        start = to_epoch_seconds(self.start_period)
+        end = to_epoch_seconds(self.end_period)
+        if self.store is not None:
+            return self.store.patients_where(
+                gender_is(Gender.FEMALE),
+                age_between(end, 52.0, 74.0),
+                has_resource("Encounter", "period.start", start, end),
+            )
+        patients = get_patient_table(self.patient_list)
+        encounters = get_timeline(self.encounter_list, "period.start")
+        count(scanned=len(patients), predicates=len(patients))
+        return population_of_rows(
+            self.patient_list,
+            bytearray(
+                gender == Gender.FEMALE
+                and 52.0 <= age <= 74.0
+                and encounters.any_within(pid, start, end)
+                for pid, gender, age in zip(
+                    patients.ids, patients.genders, patients.ages_at(end)
+                )
+            ),
+        )
+
+    def denominator(self) -> AbstractSet[str]:
         """
         Criteria:
         - Same as the initial_population
@@ -84,7 +102,7 @@ class CMS125v11Runner(BaseRunner):
         """
         return None
 
-    def numerator(self) -> set[str]:
+    def numerator(self) -> AbstractSet[str]:
         """
         Criteria:
         - Patient is in the denominator
@@ -93,28 +111,33 @@ class CMS125v11Runner(BaseRunner):
             - Mammogram ICD10 Code: 71651007. You can assume all Procedure codings are ICD10 codes,
               and plaintext descriptions are available on the CodableConcept (consider case-sensitivity).
         """
-        res = set()
         denom_set = self.denominator()
         # Shift two years earlier and set to october
         earliest_datetime = (
             arrow.get(self.start_period).shift(years=-2).replace(month=10).datetime
         )
-        for procedure in self.procedure_list:
-            # NOTE: Ok to assume start date is sufficient
-            pid = get_reference_id_from_resource(procedure)
-            if pid in denom_set:
-                # Check within range
-                procedure_start = nested_get(procedure, "performedPeriod.start")
-                if date_is_within_date_range(
-                    procedure_start, earliest_datetime, self.end_period
-                ):
-                    # Check if completed Mammogram
-                    status = procedure.get("status")
-                    # NOTE: can assume it's ICD10
-                    procedure_code = nested_get(procedure, "code.coding[0].code")
-                    if status == "completed" and str(procedure_code) == "71651007":
-                        res.add(pid)
-        return res
+        earliest = to_epoch_seconds(earliest_datetime)
+        end = to_epoch_seconds(self.end_period)
+        if self.store is not None:
+            return denom_set & self.store.patients_where(
+                has_resource(
+                    "Procedure",
+                    "performedPeriod.start",
+                    earliest,
+                    end,
+                    status="completed",
+                    concept_key="code",
+                    value_set=MAMMOGRAPHY,
+                )
+            )
+        procedures = get_columns(self.procedure_list, "Procedure")
+        # NOTE: Ok to assume start date is sufficient, and that the code is ICD10
+        mammograms = procedures.patients_where(
+            procedures.window_mask(earliest, end),
+            procedures.status_mask("completed"),
+            value_set_mask(self.procedure_list, "code", MAMMOGRAPHY),
+        )
+        return denom_set & population_of_ids(self.patient_list, mammograms)
 
     def numerator_exclusions(self) -> set[str] | None:
         """
@@ -127,3 +150,67 @@ class CMS125v11Runner(BaseRunner):
         N/A
         """
         return None
+
+    @classmethod
+    def fused_scan(cls) -> "CMS125v11Scan":
+        return CMS125v11Scan()
+
+
+class CMS125v11Scan(MeasureScan):
+    """
+    Single-pass version of `CMS125v11Runner` (see `util.engine`)
+    """
+
+    def __init__(self) -> None:
+        self.women: list[Patient] = []
+        self.encounters = PatientTimelines()
+        self.mammograms = PatientTimelines()
+
+    def handlers(self) -> dict[str, ResourceHandler]:
+        return {
+            "Patient": self.on_patient,
+            "Encounter": self.on_encounter,
+            "Procedure": self.on_procedure,
+        }
+
+    def on_patient(self, pid: str, patient: dict[str, Any]) -> None:
+        record = Patient.from_resource(patient)
+        if record.gender == Gender.FEMALE:
+            self.women.append(record)
+
+    def on_encounter(self, pid: str, encounter: dict[str, Any]) -> None:
+        self.encounters.add(pid, to_epoch_seconds(PERIOD_START(encounter)))
+
+    def on_procedure(self, pid: str, procedure: dict[str, Any]) -> None:
+        if procedure.get("status") == "completed" and MAMMOGRAPHY.matches(
+            procedure.get("code")
+        ):
+            self.mammograms.add(pid, to_epoch_seconds(PERFORMED_START(procedure)))
+
+    def results(
+        self, start_period: datetime, end_period: datetime
+    ) -> dict[str, AbstractSet[str] | None]:
+        start = to_epoch_seconds(start_period)
+        end = to_epoch_seconds(end_period)
+        # Same mammogram lookback as `CMS125v11Runner.numerator`
+        earliest = to_epoch_seconds(
+            arrow.get(start_period).shift(years=-2).replace(month=10).datetime
+        )
+        initial_population = {
+            patient.id
+            for patient in self.women
+            if 52.0 <= patient.age_at(end) <= 74.0
+            and self.encounters.any_within(patient.id, start, end)
+        }
+        return {
+            "initial_population": initial_population,
+            "denominator": initial_population,
+            "denominator_exclusions": None,
+            "numerator": {
+                pid
+                for pid in initial_population
+                if self.mammograms.any_within(pid, earliest, end)
+            },
+            "numerator_exclusions": None,
+            "denominator_exceptions": None,
+        }
@@ -1,14 +1,22 @@
 from datetime import datetime
-from typing import Any
+from typing import AbstractSet, Any
 
-import arrow
-from util.helpers import (
-    date_is_within_date_range,
-    get_datediff_in_years,
-    get_reference_id_from_resource,
-    nested_get,
-)
-from util.runner import BaseRunner
+from util.columns import get_columns
+from util.dates import month_of, to_epoch_seconds
+from util.helpers import compile_path
+from util.instrument import count
+from util.patients import Patient, get_patient_table
+from util.populations import population_of_ids
+from util.runner import BaseRunner, MeasureScan, ResourceHandler
+from util.static import INFLUENZA_VACCINE
+from util.store import ResourceStore, any_of, has_resource
+from util.terminology import value_set_mask
+from util.timeline import PatientTimelines, get_monthly_timeline, get_timeline
+
+PERIOD_START = compile_path("period.start")
+PERIOD_END = compile_path("period.end")
+# October through March
+FLU_SEASON_MONTHS = (10, 11, 12, 1, 2, 3)
 
 
 class CMS147v11Runner(BaseRunner):
@@ -20,20 +28,39 @@ class CMS147v11Runner(BaseRunner):
     Each function docstring will specify additional exceptions + cases to focus on for the purpose of this lab.
     """
 
+    RESOURCE_FIELDS = {
+        "Patient": ("id", "birthDate"),
+        "Encounter": ("subject.reference", "period.start", "period.end"),
+        "Immunization": (
+            "patient.reference",
+            "occurrenceDateTime",
+            "status",
+            "vaccineCode.coding",
+        ),
+    }
+
     def __init__(
         self,
         start_period: datetime,
         end_period: datetime,
-        patient_list: list[dict[str, Any]],
-        encounter_list: list[dict[str, Any]],
-        immunization_list: list[dict[str, Any]],
+        patient_list: list[dict[str, Any]] | None = None,
+        encounter_list: list[dict[str, Any]] | None = None,
+        immunization_list: list[dict[str, Any]] | None = None,
+        store: ResourceStore | None = None,
     ):
+        """
+        Use the provided lists, or query `store` (see `util.store`) instead
+        """
         super().__init__(start_period, end_period)
-        self.patient_list = patient_list
-        self.encounter_list = encounter_list
-        self.immunization_list = immunization_list
+        if store is None and None in (patient_list, encounter_list, immunization_list):
+            raise ValueError("Pass every resource list, or a store")
+        # Left empty in store mode, where the stages query `store` instead
+        self.patient_list = [] if patient_list is None else patient_list
+        self.encounter_list = [] if encounter_list is None else encounter_list
+        self.immunization_list = [] if immunization_list is None else immunization_list
+        self.store = store
 
-    def initial_population(self) -> set[str]:
+    def initial_population(self) -> AbstractSet[str]:
         """
         Criteria:
         - Patient has an Encounter during the measurement period
@@ -42,18 +69,26 @@ class CMS147v11Runner(BaseRunner):
         # Implement code for the calculating the Initial Population here.
         # FIXME
         res = set()
-        for encounter in self.encounter_list:
-            pid = get_reference_id_from_resource(encounter)
-            encounterDate = nested_get(encounter, 'period.start')
-            if date_is_within_date_range(encounterDate, self.start_period, self.end_period):
-                for patient in self.patient_list:
-                    if patient.get('id') == pid:
-                        age = get_datediff_in_years(patient.get('birthDate'), encounterDate)
-                        if age >= 0.5:
-                            res.add(pid)
-        return res
-
-    def denominator(self) -> set[str]:
+        start = to_epoch_seconds(self.start_period)
+        end = to_epoch_seconds(self.end_period)
+        if self.store is not None:
+            # Age only grows, so any encounter at 0.5 or older means the latest one is
+            return self.store.patients_where(
+                has_resource("Encounter", "period.start", start, end, min_age=0.5)
+            )
+        patients = get_patient_table(self.patient_list)
+        encounter_starts = get_timeline(self.encounter_list, "period.start")
+        count(scanned=len(patients), predicates=len(patients))
+        for pid in patients.rows:
+            # Age only grows, so the latest encounter in the period decides
+            encounterDate = encounter_starts.latest_within(pid, start, end)
+            if encounterDate is not None:
+                age = patients.age_at(pid, encounterDate)
+                if age is not None and age >= 0.5:
+                    res.add(pid)
+        return population_of_ids(self.patient_list, res)
+
+    def denominator(self) -> AbstractSet[str]:
         """
         Criteria:
         - Patient is in the initial population
@@ -64,19 +99,33 @@ class CMS147v11Runner(BaseRunner):
         # FIXME
         res = set()
         initial_pop = self.initial_population()
-        for encounter in self.encounter_list:
-            patient = encounter.get('subject')
-            pid = patient.get('reference')[8:]          # get patient id from encounter
-            # print(pid)
-            if pid in initial_pop:                      # if the patient id is in the initial population
-                start = nested_get(encounter, "period.start")
-                end = nested_get(encounter, "period.end")
-                startMonth = int(start.split('-')[1])
-                endMonth = int(end.split('-')[1])
-                if (date_is_within_date_range(start, self.start_period, self.end_period) and (startMonth <= 3 or startMonth >= 10) or (date_is_within_date_range(end, self.start_period, self.end_period) and (endMonth <= 3 or endMonth >= 10))):
-                    res.add(pid)
-            
-        return res
+        start = to_epoch_seconds(self.start_period)
+        end = to_epoch_seconds(self.end_period)
+        if self.store is not None:
+            return initial_pop & self.store.patients_where(
+                any_of(
+                    has_resource(
+                        "Encounter",
+                        "period.start",
+                        start,
+                        end,
+                        months=FLU_SEASON_MONTHS,
+                    ),
+                    has_resource(
+                        "Encounter", "period.end", start, end, months=FLU_SEASON_MONTHS
+                    ),
+                )
+            )
+        encounter_starts = get_monthly_timeline(self.encounter_list, "period.start")
+        encounter_ends = get_monthly_timeline(self.encounter_list, "period.end")
+        count(scanned=len(initial_pop), predicates=2 * len(initial_pop))
+        for pid in initial_pop:
+            if encounter_starts.any_within(
+                pid, FLU_SEASON_MONTHS, start, end
+            ) or encounter_ends.any_within(pid, FLU_SEASON_MONTHS, start, end):
+                res.add(pid)
+
+        return population_of_ids(self.patient_list, res)
 
     def denominator_exclusions(self) -> set[str] | None:
         """
@@ -84,7 +133,7 @@ class CMS147v11Runner(BaseRunner):
         """
         return None
 
-    def numerator(self) -> set[str]:
+    def numerator(self) -> AbstractSet[str]:
         """
         Criteria:
         - Patient is in the denominator
@@ -95,17 +144,28 @@ class CMS147v11Runner(BaseRunner):
         """
         # Implement code for calculating the Numerator here.
         # FIXME
-        res = set()
         denom = self.denominator()
-        for immunization in self.immunization_list:
-            pid = immunization.get('patient').get('reference')[8:]
-            if pid in denom:
-                code = nested_get(immunization, "vaccineCode.coding")[0].get('code')
-                date = immunization.get('occurrenceDateTime')
-                status = immunization.get('status')
-                if code == '140' and date_is_within_date_range(date, self.start_period, self.end_period) and status == 'completed':
-                    res.add(pid)
-        return res
+        start = to_epoch_seconds(self.start_period)
+        end = to_epoch_seconds(self.end_period)
+        if self.store is not None:
+            return denom & self.store.patients_where(
+                has_resource(
+                    "Immunization",
+                    "occurrenceDateTime",
+                    start,
+                    end,
+                    status="completed",
+                    concept_key="vaccineCode",
+                    value_set=INFLUENZA_VACCINE,
+                )
+            )
+        immunizations = get_columns(self.immunization_list, "Immunization")
+        flu_shots = immunizations.patients_where(
+            value_set_mask(self.immunization_list, "vaccineCode", INFLUENZA_VACCINE),
+            immunizations.status_mask("completed"),
+            immunizations.window_mask(start, end),
+        )
+        return denom & population_of_ids(self.patient_list, flu_shots)
 
     def numerator_exclusions(self) -> set[str] | None:
         """
@@ -118,3 +178,81 @@ class CMS147v11Runner(BaseRunner):
         Students Not Required to Implement
         """
         return None
+
+    @classmethod
+    def fused_scan(cls) -> "CMS147v11Scan":
+        return CMS147v11Scan()
+
+
+def _in_flu_season(date: str | None) -> bool:
+    # Same month split as `get_monthly_timeline`, used by `CMS147v11Runner`
+    return date is not None and month_of(date) in FLU_SEASON_MONTHS
+
+
+class CMS147v11Scan(MeasureScan):
+    """
+    Single-pass version of `CMS147v11Runner` (see `util.engine`)
+    """
+
+    def __init__(self) -> None:
+        self.patients: list[Patient] = []
+        self.encounter_starts = PatientTimelines()
+        # Encounters whose start / end date falls between October and March
+        self.flu_season_starts = PatientTimelines()
+        self.flu_season_ends = PatientTimelines()
+        self.flu_shots = PatientTimelines()
+
+    def handlers(self) -> dict[str, ResourceHandler]:
+        return {
+            "Patient": self.on_patient,
+            "Encounter": self.on_encounter,
+            "Immunization": self.on_immunization,
+        }
+
+    def on_patient(self, pid: str, patient: dict[str, Any]) -> None:
+        self.patients.append(Patient.from_resource(patient))
+
+    def on_encounter(self, pid: str, encounter: dict[str, Any]) -> None:
+        start = to_epoch_seconds(PERIOD_START(encounter))
+        self.encounter_starts.add(pid, start)
+        if _in_flu_season(PERIOD_START(encounter)):
+            self.flu_season_starts.add(pid, start)
+        if _in_flu_season(PERIOD_END(encounter)):
+            self.flu_season_ends.add(pid, to_epoch_seconds(PERIOD_END(encounter)))
+
+    def on_immunization(self, pid: str, immunization: dict[str, Any]) -> None:
+        if (
+            INFLUENZA_VACCINE.matches(immunization.get("vaccineCode"))
+            and immunization.get("status") == "completed"
+        ):
+            self.flu_shots.add(
+                pid, to_epoch_seconds(immunization.get("occurrenceDateTime"))
+            )
+
+    def results(
+        self, start_period: datetime, end_period: datetime
+    ) -> dict[str, AbstractSet[str] | None]:
+        start = to_epoch_seconds(start_period)
+        end = to_epoch_seconds(end_period)
+        initial_population = set()
+        for patient in self.patients:
+            # Ages only grow, so the period's latest encounter decides the 0.5 years
+            latest = self.encounter_starts.latest_within(patient.id, start, end)
+            if latest is not None and patient.age_at(latest) >= 0.5:
+                initial_population.add(patient.id)
+        denominator = {
+            pid
+            for pid in initial_population
+            if self.flu_season_starts.any_within(pid, start, end)
+            or self.flu_season_ends.any_within(pid, start, end)
+        }
+        return {
+            "initial_population": initial_population,
+            "denominator": denominator,
+            "denominator_exclusions": None,
+            "numerator": {
+                pid for pid in denominator if self.flu_shots.any_within(pid, start, end)
+            },
+            "numerator_exclusions": None,
+            "denominator_exceptions": None,
+        }
@@ -1,16 +1,22 @@
 from datetime import datetime
-from typing import Any
-
-import arrow
-from util.helpers import (
-    get_datediff_in_years,
-    date_is_within_date_range,
-    get_reference_id_from_resource,
-    get_resource_sublist,
-    nested_get,
+from typing import AbstractSet, Any
+
+from util.dates import to_epoch_seconds
+from util.helpers import get_patient_index
+from util.instrument import count
+from util.observations import (
+    BLOOD_PRESSURE_COMPONENTS,
+    component_value,
+    get_component_column,
+    get_reading_timeline,
 )
-from util.runner import BaseRunner
-from util.static import ADVANCED_ILLNESS_SET
+from util.patients import Patient, get_patient_table
+from util.populations import population_of_ids, population_of_rows
+from util.runner import BaseRunner, MeasureScan, ResourceHandler
+from util.static import ADVANCED_ILLNESS, HYPERTENSION
+from util.store import ResourceStore, age_between, has_resource
+from util.terminology import TERMINOLOGY, get_value_set_column
+from util.timeline import PatientTimelines
 
 
 class CMS165v11Runner(BaseRunner):
@@ -22,20 +28,40 @@ class CMS165v11Runner(BaseRunner):
     Each function docstring will specify additional exceptions + cases to focus on for the purpose of this lab.
     """
 
+    RESOURCE_FIELDS = {
+        "Patient": ("id", "birthDate"),
+        "Condition": ("subject.reference", "code.coding"),
+        "Observation": (
+            "subject.reference",
+            "effectiveDateTime",
+            "code.coding",
+            "component.code",
+            "component.valueQuantity.value",
+        ),
+    }
+
     def __init__(
         self,
         start_period: datetime,
         end_period: datetime,
-        patient_list: list[dict[str, Any]],
-        condition_list: list[dict[str, Any]],
-        observation_list: list[dict[str, Any]],
+        patient_list: list[dict[str, Any]] | None = None,
+        condition_list: list[dict[str, Any]] | None = None,
+        observation_list: list[dict[str, Any]] | None = None,
+        store: ResourceStore | None = None,
     ):
+        """
+        Use the provided lists, or query `store` (see `util.store`) instead
+        """
         super().__init__(start_period, end_period)
-        self.patient_list = patient_list
-        self.condition_list = condition_list
-        self.observation_list = observation_list
+        if store is None and None in (patient_list, condition_list, observation_list):
+            raise ValueError("Pass every resource list, or a store")
+        # Left empty in store mode, where the stages query `store` instead
+        self.patient_list = [] if patient_list is None else patient_list
+        self.condition_list = [] if condition_list is None else condition_list
+        self.observation_list = [] if observation_list is None else observation_list
+        self.store = store
 
-    def initial_population(self) -> set[str]:
+    def initial_population(self) -> AbstractSet[str]:
         """
         Criteria:
         - Patient age is between 18.0 and 85.0 at the end period
@@ -47,25 +73,31 @@ class CMS165v11Runner(BaseRunner):
         # Implement code for the calculating the Initial Population here.
         # FIXME
         res = set()
-        for patient in self.patient_list:
-            age = get_datediff_in_years(patient.get("birthDate"), self.end_period)
+        end = to_epoch_seconds(self.end_period)
+        if self.store is not None:
+            return self.store.patients_where(
+                age_between(end, 18.0, 85.0),
+                has_resource("Condition", concept_key="code", value_set=HYPERTENSION),
+            )
+        patients = get_patient_table(self.patient_list)
+        condition_index = get_patient_index(self.condition_list)
+        condition_value_sets = get_value_set_column(self.condition_list, "code")
+        for pid, age in zip(patients.ids, patients.ages_at(end)):
             if 18.0 <= age <= 85.0:
-                pid = patient.get("id")
-                condition_list = get_resource_sublist(self.condition_list, {pid})
-                for c in condition_list:
-                    snom = nested_get(c, "code.coding")[0]
-                    if snom.get('code') == '59621000':
-
+                rows = condition_index.get(pid, [])
+                count(scanned=len(rows), predicates=len(rows))
+                for i in rows:
+                    if condition_value_sets[i] & HYPERTENSION.bit:
                         res.add(pid)
-        return res
+        return population_of_ids(self.patient_list, res)
 
-    def denominator(self) -> set[str]:
+    def denominator(self) -> AbstractSet[str]:
         """
         Equals Initial Population
         """
         return self.initial_population()
 
-    def denominator_exclusions(self) -> set[str] | None:
+    def denominator_exclusions(self) -> AbstractSet[str] | None:
         """
         Criteria:
         - Patient is in the denominator
@@ -77,26 +109,34 @@ class CMS165v11Runner(BaseRunner):
         # FIXME
         denom = self.denominator()
         res = set()
-        temp = set()
-        for patient in self.patient_list:
-            pid = patient.get('id')
-            if pid in denom:
-                birthdate = patient.get('birthDate')
-                age = get_datediff_in_years(birthdate, self.end_period)
-                if 66 <= age <= 80:
-                    temp.add(pid)
-        
-        for condition in self.condition_list:
-            pid = get_reference_id_from_resource(condition)
-            if pid in temp:
-                con = nested_get(condition, 'code.coding')[0].get('display')
-                if con in ADVANCED_ILLNESS_SET:
+        end = to_epoch_seconds(self.end_period)
+        if self.store is not None:
+            return denom & self.store.patients_where(
+                age_between(end, 66, 80),
+                has_resource(
+                    "Condition", concept_key="code", value_set=ADVANCED_ILLNESS
+                ),
+            )
+        # Shared with `initial_population`, so ages are only computed once
+        patients = get_patient_table(self.patient_list)
+        temp = denom & population_of_rows(
+            self.patient_list,
+            bytearray(66 <= age <= 80 for age in patients.ages_at(end)),
+        )
+
+        condition_index = get_patient_index(self.condition_list)
+        condition_value_sets = get_value_set_column(self.condition_list, "code")
+        for pid in temp:
+            rows = condition_index.get(pid, [])
+            count(scanned=len(rows), predicates=len(rows))
+            for i in rows:
+                if condition_value_sets[i] & ADVANCED_ILLNESS.bit:
                     res.add(pid)
 
-        return res
+        return population_of_ids(self.patient_list, res)
         ...
 
-    def numerator(self) -> set[str]:
+    def numerator(self) -> AbstractSet[str]:
         """
         Criteria:
         - Patient is in the denominator
@@ -108,44 +148,31 @@ class CMS165v11Runner(BaseRunner):
         # FIXME
         denom = self.denominator()
         res = set()
-        temp = {}
-        for observation in self.observation_list:
-            pid = get_reference_id_from_resource(observation)
-            if pid in denom:
-                effectiveDate = observation.get('effectiveDateTime')
-                if date_is_within_date_range(effectiveDate, self.start_period, self.end_period):
-                    components = observation.get('component')
-                    dia = False
-                    sys = False
-                    diastolic = 0
-                    systolic = 0
-                    if components != None:
-                        for c in components:
-                            text = (c.get('code').get('text'))
-                            if text == 'Diastolic Blood Pressure':
-                                diastolic = c.get('valueQuantity').get('value')
-                                dia = True
-                            if text == 'Systolic Blood Pressure':
-                                systolic = c.get('valueQuantity').get('value')
-                                sys = True
-                    if pid in temp:
-                        if temp.get(pid)[0] <= effectiveDate and dia and sys:
-                            temp[pid][0] = effectiveDate
-                            if diastolic <= 90 and systolic <= 140:
-                                temp[pid][1] = True
-                            else: 
-                                temp[pid][1] = False
-                    else:
-                        if dia and sys:
-                            if diastolic <= 90 and systolic <= 140:
-                                temp[pid] = [effectiveDate, True]
-                            else:
-                                temp[pid] = [effectiveDate, False]
-
-        for key, value in temp.items():
-            if value[1] == True:
-                res.add(key)
-        return res
+        start = to_epoch_seconds(self.start_period)
+        end = to_epoch_seconds(self.end_period)
+        if self.store is not None:
+            latest = self.store.latest_readings(BLOOD_PRESSURE_COMPONENTS, start, end)
+            return denom & self.store.population(
+                pid
+                for pid, (systolic, diastolic) in latest.items()
+                if diastolic <= 90 and systolic <= 140
+            )
+        readings = get_reading_timeline(
+            self.observation_list, BLOOD_PRESSURE_COMPONENTS
+        )
+        systolic = get_component_column(
+            self.observation_list, "Systolic Blood Pressure"
+        )
+        diastolic = get_component_column(
+            self.observation_list, "Diastolic Blood Pressure"
+        )
+        count(scanned=len(denom), predicates=len(denom))
+        for pid in denom:
+            # Latest reading with both components, by effectiveDateTime
+            i = readings.latest_row_within(pid, start, end)
+            if i is not None and diastolic[i] <= 90 and systolic[i] <= 140:
+                res.add(pid)
+        return population_of_ids(self.patient_list, res)
 
     def numerator_exclusions(self) -> set[str] | None:
         """
@@ -158,3 +185,79 @@ class CMS165v11Runner(BaseRunner):
         None
         """
         return None
+
+    @classmethod
+    def fused_scan(cls) -> "CMS165v11Scan":
+        return CMS165v11Scan()
+
+
+class CMS165v11Scan(MeasureScan):
+    """
+    Single-pass version of `CMS165v11Runner` (see `util.engine`)
+    """
+
+    def __init__(self) -> None:
+        self.patients: list[Patient] = []
+        self.has_hypertension: set[str] = set()
+        self.has_advanced_illness: set[str] = set()
+        # Complete BP readings, valued by whether they are controlled
+        self.bp_readings = PatientTimelines()
+
+    def handlers(self) -> dict[str, ResourceHandler]:
+        return {
+            "Patient": self.on_patient,
+            "Condition": self.on_condition,
+            "Observation": self.on_observation,
+        }
+
+    def on_patient(self, pid: str, patient: dict[str, Any]) -> None:
+        self.patients.append(Patient.from_resource(patient))
+
+    def on_condition(self, pid: str, condition: dict[str, Any]) -> None:
+        value_sets = TERMINOLOGY.concept_bits(condition.get("code"))
+        if value_sets & HYPERTENSION.bit:
+            self.has_hypertension.add(pid)
+        if value_sets & ADVANCED_ILLNESS.bit:
+            self.has_advanced_illness.add(pid)
+
+    def on_observation(self, pid: str, observation: dict[str, Any]) -> None:
+        # Same extraction as `get_component_column`, used by `CMS165v11Runner`
+        systolic = component_value(observation, "Systolic Blood Pressure")
+        diastolic = component_value(observation, "Diastolic Blood Pressure")
+        if systolic == systolic and diastolic == diastolic:
+            self.bp_readings.add(
+                pid,
+                to_epoch_seconds(observation.get("effectiveDateTime")),
+                diastolic <= 90 and systolic <= 140,
+            )
+
+    def results(
+        self, start_period: datetime, end_period: datetime
+    ) -> dict[str, AbstractSet[str] | None]:
+        start = to_epoch_seconds(start_period)
+        end = to_epoch_seconds(end_period)
+        ages = {patient.id: patient.age_at(end) for patient in self.patients}
+        initial_population = {
+            pid
+            for pid in self.has_hypertension
+            if pid in ages and 18.0 <= ages[pid] <= 85.0
+        }
+        denominator = initial_population
+        numerator = set()
+        for pid in denominator:
+            # Latest reading in the period, as in `CMS165v11Runner.numerator`
+            readings = self.bp_readings.values_within(pid, start, end)
+            if readings and readings[-1]:
+                numerator.add(pid)
+        return {
+            "initial_population": initial_population,
+            "denominator": denominator,
+            "denominator_exclusions": {
+                pid
+                for pid in denominator & self.has_advanced_illness
+                if 66 <= ages[pid] <= 80
+            },
+            "numerator": numerator,
+            "numerator_exclusions": None,
+            "denominator_exceptions": None,
+        }
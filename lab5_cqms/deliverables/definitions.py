@@ -0,0 +1,86 @@
+"""
+The eCQMs as `util.measures` definitions, compiled into runners.
+
+Each definition states the same criteria as the hand-written runner of the same name
+(and yields the same populations), without any evaluation code.
+"""
+
+from deliverables.cms147v11 import FLU_SEASON_MONTHS
+from util.measures import (
+    AgeBetween,
+    AnyOf,
+    GenderIs,
+    HasResource,
+    LatestReadingAtMost,
+    MeasureDefinition,
+    Window,
+    runner_for,
+)
+from util.patients import Gender
+from util.static import ADVANCED_ILLNESS, HYPERTENSION, INFLUENZA_VACCINE, MAMMOGRAPHY
+
+CMS125v11 = MeasureDefinition(
+    "CMS125v11",
+    "CMS125v11 - Breast Cancer Screening",
+    initial_population=[
+        GenderIs(Gender.FEMALE),
+        AgeBetween(52.0, 74.0),
+        HasResource("Encounter", "period.start"),
+    ],
+    numerator=[
+        # Completed mammogram from October two years before the period starts
+        HasResource(
+            "Procedure",
+            "performedPeriod.start",
+            window=Window(start_shift={"years": -2}, start_replace={"month": 10}),
+            status="completed",
+            value_set=MAMMOGRAPHY,
+        ),
+    ],
+)
+
+CMS147v11 = MeasureDefinition(
+    "CMS147v11",
+    "CMS147v11 - Preventive Care and Screening: Influenza Immunization",
+    initial_population=[
+        HasResource("Encounter", "period.start", min_age=0.5),
+    ],
+    denominator=[
+        AnyOf(
+            HasResource("Encounter", "period.start", months=FLU_SEASON_MONTHS),
+            HasResource("Encounter", "period.end", months=FLU_SEASON_MONTHS),
+        ),
+    ],
+    numerator=[
+        HasResource(
+            "Immunization",
+            "occurrenceDateTime",
+            status="completed",
+            value_set=INFLUENZA_VACCINE,
+            concept_key="vaccineCode",
+        ),
+    ],
+)
+
+CMS165v11 = MeasureDefinition(
+    "CMS165v11",
+    "CMS165v11 - Controlling High Blood Pressure",
+    initial_population=[
+        AgeBetween(18.0, 85.0),
+        HasResource("Condition", value_set=HYPERTENSION),
+    ],
+    denominator_exclusions=[
+        AgeBetween(66, 80),
+        HasResource("Condition", value_set=ADVANCED_ILLNESS),
+    ],
+    numerator=[
+        LatestReadingAtMost(
+            {"Systolic Blood Pressure": 140, "Diastolic Blood Pressure": 90}
+        ),
+    ],
+)
+
+DEFINITIONS = [CMS125v11, CMS147v11, CMS165v11]
+
+# Runners compiled from `DEFINITIONS`, named like the hand-written ones
+DEFINED_RUNNERS = [runner_for(definition) for definition in DEFINITIONS]
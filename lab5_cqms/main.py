@@ -1,8 +1,20 @@
-import json
 import pathlib
+from datetime import datetime
 
 import arrow
-from deliverables import CMS125v11Runner, CMS147v11Runner, CMS165v11Runner
+from deliverables import (
+    ALL_RUNNERS,
+    CMS125v11Runner,
+    CMS147v11Runner,
+    CMS165v11Runner,
+)
+from deliverables.definitions import DEFINED_RUNNERS
+from util.cache import load_ndjson_cached
+from util.loader import get_required_fields, ndjson_path
+from util.parallel import run_runners
+from util.pipeline import run_pipelined
+from util.sharding import build_runner
+from util.store import ResourceStore
 
 # NOTE: Set this to True to use the test_subset locally.
 #       Set this to False to run on the full data.
@@ -10,6 +22,34 @@ from deliverables import CMS125v11Runner, CMS147v11Runner, CMS165v11Runner
 
 USE_TEST_SUBSET = False
 
+# NOTE: Number of processes to run the measures on. 1 runs them one after another.
+NUM_WORKERS = 1
+
+# NOTE: Set this to True to also save per-stage timings and counters
+#       to output/<Runner>/instrumentation.json
+INSTRUMENT = False
+
+# NOTE: Set this to a directory only you can write to (e.g. ~/.cache/cqm) to cache the
+#       parsed resources there and reuse them until a data file changes.
+#       None always re-parses the NDJSON files.
+CACHE_DIR = None
+
+# NOTE: Set this to True to load the files concurrently and start each eCQM as soon
+#       as its own files are loaded (results then print in completion order).
+PIPELINED = False
+
+# NOTE: Number of processes to parse each NDJSON file with (when it is not cached).
+#       Files may also be gzip (.ndjson.gz) or zstd (.ndjson.zst) compressed.
+PARSE_WORKERS = 1
+
+# NOTE: Set this to the path of a database built with `python -m util.store` to run the
+#       eCQMs as queries against it instead of loading the NDJSON files into memory
+STORE_PATH = None
+
+# NOTE: Set this to True to run the declarative definitions of the eCQMs
+#       (deliverables/definitions.py) instead of the hand-written runners
+DECLARATIVE = False
+
 
 DATA_DIR = f"{pathlib.Path(__file__).parent.parent.absolute()}/data"
 OUTPUT_DIR = f"{pathlib.Path(__file__).parent.absolute()}/output"
@@ -19,27 +59,139 @@ if USE_TEST_SUBSET:
     DATA_DIR = f"{TEST_SUBSET_DIR}/data"
     OUTPUT_DIR = f"{TEST_SUBSET_DIR}/output"
 
-MEASUREMENT_PERIOD_START_DATETIME = arrow.get(
+MEASUREMENT_PERIOD_START_DATETIME: datetime = arrow.get(
     "2018-01-01"
 ).datetime  # 2018-01-01 00:00:00+00:00
-MEASUREMENT_PERIOD_END_DATETIME = arrow.get(
+MEASUREMENT_PERIOD_END_DATETIME: datetime = arrow.get(
     "2022-01-01"
 ).datetime  # 2022-01-01 00:00:00+00:00
 
 
+def check_settings() -> None:
+    """
+    Raises ValueError if the settings above combine ways of running that don't go
+    together, instead of letting one of them silently win
+    """
+    modes = [
+        name
+        for name, enabled in (
+            ("PIPELINED", PIPELINED),
+            ("STORE_PATH", STORE_PATH),
+            ("DECLARATIVE", DECLARATIVE),
+        )
+        if enabled
+    ]
+    if len(modes) > 1:
+        raise ValueError(f"{' and '.join(modes)} cannot be combined")
+    if PIPELINED and NUM_WORKERS > 1:
+        # Measures run on the calling thread as soon as their files are loaded
+        raise ValueError("NUM_WORKERS > 1 cannot be combined with PIPELINED")
+    if STORE_PATH:
+        # Nothing is loaded from the NDJSON files, and queries run sequentially
+        for name, applies in (
+            ("NUM_WORKERS > 1", NUM_WORKERS > 1),
+            ("CACHE_DIR", CACHE_DIR is not None),
+            ("PARSE_WORKERS > 1", PARSE_WORKERS > 1),
+        ):
+            if applies:
+                raise ValueError(f"{name} cannot be combined with STORE_PATH")
+
+
 if __name__ == "__main__":
-    # Local helper function
-    def load_ndjson_file(filepath: str) -> list[dict]:
-        with open(filepath, "r") as file:
-            return [dict(json.loads(line)) for line in file]
+    check_settings()
+
+if __name__ == "__main__" and PIPELINED:
+    results = run_pipelined(
+        ALL_RUNNERS,
+        MEASUREMENT_PERIOD_START_DATETIME,
+        MEASUREMENT_PERIOD_END_DATETIME,
+        DATA_DIR,
+        cache_dir=CACHE_DIR,
+        print_counts=True,
+        save_to_dir=OUTPUT_DIR,
+        instrument=INSTRUMENT,
+        parse_workers=PARSE_WORKERS,
+    )
+elif __name__ == "__main__" and STORE_PATH:
+    store = ResourceStore(STORE_PATH)
+    runners = [
+        runner_class(
+            MEASUREMENT_PERIOD_START_DATETIME,
+            MEASUREMENT_PERIOD_END_DATETIME,
+            store=store,
+        )
+        for runner_class in ALL_RUNNERS
+    ]
+    if INSTRUMENT:
+        for runner in runners:
+            runner.enable_instrumentation()
+    # Sequential: the SQLite connection must not be shared with forked workers
+    results = run_runners(runners, print_counts=True, save_to_dir=OUTPUT_DIR)
+    store.close()
+elif __name__ == "__main__" and DECLARATIVE:
+    fields = get_required_fields(DEFINED_RUNNERS)
+    resources = {
+        resource_type: load_ndjson_cached(
+            ndjson_path(DATA_DIR, resource_type),
+            resource_fields,
+            CACHE_DIR,
+            PARSE_WORKERS,
+        )
+        for resource_type, resource_fields in fields.items()
+    }
+    runners = [
+        build_runner(
+            runner_class,
+            MEASUREMENT_PERIOD_START_DATETIME,
+            MEASUREMENT_PERIOD_END_DATETIME,
+            resources,
+        )
+        for runner_class in DEFINED_RUNNERS
+    ]
+    if INSTRUMENT:
+        for runner in runners:
+            runner.enable_instrumentation()
+    results = run_runners(
+        runners, num_workers=NUM_WORKERS, print_counts=True, save_to_dir=OUTPUT_DIR
+    )
+elif __name__ == "__main__":
+    # Only keep the fields the runners actually read
+    fields = get_required_fields(ALL_RUNNERS)
 
     # Initiate lists
-    patient_list = load_ndjson_file(f"{DATA_DIR}/Patient.ndjson")
-    observation_list = load_ndjson_file(f"{DATA_DIR}/Observation.ndjson")
-    condition_list = load_ndjson_file(f"{DATA_DIR}/Condition.ndjson")
-    encounter_list = load_ndjson_file(f"{DATA_DIR}/Encounter.ndjson")
-    immunization_list = load_ndjson_file(f"{DATA_DIR}/Immunization.ndjson")
-    procedure_list = load_ndjson_file(f"{DATA_DIR}/Procedure.ndjson")
+    patient_list = load_ndjson_cached(
+        ndjson_path(DATA_DIR, "Patient"), fields["Patient"], CACHE_DIR, PARSE_WORKERS
+    )
+    observation_list = load_ndjson_cached(
+        ndjson_path(DATA_DIR, "Observation"),
+        fields["Observation"],
+        CACHE_DIR,
+        PARSE_WORKERS,
+    )
+    condition_list = load_ndjson_cached(
+        ndjson_path(DATA_DIR, "Condition"),
+        fields["Condition"],
+        CACHE_DIR,
+        PARSE_WORKERS,
+    )
+    encounter_list = load_ndjson_cached(
+        ndjson_path(DATA_DIR, "Encounter"),
+        fields["Encounter"],
+        CACHE_DIR,
+        PARSE_WORKERS,
+    )
+    immunization_list = load_ndjson_cached(
+        ndjson_path(DATA_DIR, "Immunization"),
+        fields["Immunization"],
+        CACHE_DIR,
+        PARSE_WORKERS,
+    )
+    procedure_list = load_ndjson_cached(
+        ndjson_path(DATA_DIR, "Procedure"),
+        fields["Procedure"],
+        CACHE_DIR,
+        PARSE_WORKERS,
+    )
 
     # Run each eCQM
     runners = [
@@ -65,5 +217,9 @@ if __name__ == "__main__":
             observation_list=observation_list,
         ),
     ]
-    for runner in runners:
-        result_dict = runner.run_all(print_counts=True, save_to_dir=OUTPUT_DIR)
+    if INSTRUMENT:
+        for runner in runners:
+            runner.enable_instrumentation()
+    results = run_runners(
+        runners, num_workers=NUM_WORKERS, print_counts=True, save_to_dir=OUTPUT_DIR
+    )
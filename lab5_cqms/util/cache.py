@@ -0,0 +1,115 @@
+"""
+On-disk cache of parsed, projected NDJSON resources.
+
+The first load of a file parses it as usual and writes the projected resources to
+`<cache_dir>/<key>.bin` in `marshal` format, behind a small header that records the
+`marshal` format and Python version that wrote it and the source file's size and mtime.
+Later loads check the header against the source and the running interpreter and, if it
+still matches, rebuild the resources with a single `marshal.load`, which is much cheaper
+than `json.loads` on every line. Changing anything else (e.g. `MEASUREMENT_PERIOD_*`)
+keeps the cache valid; a changed source file is re-parsed and re-cached, and so is a
+cache file that can't be read back (e.g. one left truncated).
+
+Cache files are unmarshalled as trusted resources, so the cache directory must be
+private to the current user: it is created with mode 0o700, and an existing one owned by
+another user, or that anyone else can write to, is refused.
+"""
+
+import hashlib
+import marshal
+import os
+import struct
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from os import getpid, lstat, makedirs, path, replace, stat
+from stat import S_ISDIR
+from typing import Any, Iterable
+
+from util.loader import load_ndjson_file
+
+# Magic, format version, marshal version, Python major / minor, source size, source
+# mtime (ns)
+_HEADER = struct.Struct("<4sHHBBQq")
+_MAGIC = b"CQMC"
+_VERSION = 2
+
+
+def cache_path(cache_dir: str, filepath: str, fields: Iterable[str] | None) -> str:
+    """
+    Cache file for `filepath` projected to `fields` (each projection is cached apart)
+    """
+    projection = "*" if fields is None else ",".join(sorted(fields))
+    key = f"{path.abspath(filepath)}\0{projection}"
+    return f"{cache_dir}/{hashlib.sha1(key.encode()).hexdigest()}.bin"
+
+
+def check_cache_dir(cache_dir: str) -> None:
+    """
+    Creates `cache_dir` if needed, and raises PermissionError unless it is a directory
+    owned by the current user with no group or other permissions
+    """
+    makedirs(cache_dir, mode=0o700, exist_ok=True)
+    if not hasattr(os, "getuid"):
+        # No POSIX owners or modes to check (Windows)
+        return
+    st = lstat(cache_dir)
+    if not S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise PermissionError(
+            f"Cache directory {cache_dir} must be a directory private to the"
+            " current user"
+        )
+
+
+def _header(size: int, mtime_ns: int) -> bytes:
+    return _HEADER.pack(
+        _MAGIC, _VERSION, marshal.version, *sys.version_info[:2], size, mtime_ns
+    )
+
+
+def _read_cache(filepath: str, size: int, mtime_ns: int) -> list[dict[str, Any]] | None:
+    # Anything short of a complete, matching cache file is a miss
+    try:
+        with open(filepath, "rb") as file:
+            if file.read(_HEADER.size) != _header(size, mtime_ns):
+                return None
+            resource_list = marshal.load(file)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    return resource_list if isinstance(resource_list, list) else None
+
+
+def _write_cache(
+    filepath: str, size: int, mtime_ns: int, resource_list: list[dict[str, Any]]
+) -> None:
+    # Written next to the final path and renamed, so readers never see a partial file
+    tmp_path = f"{filepath}.{getpid()}.tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(_header(size, mtime_ns))
+        marshal.dump(resource_list, file)
+    replace(tmp_path, filepath)
+
+
+def load_ndjson_cached(
+    filepath: str,
+    fields: Iterable[str] | None = None,
+    cache_dir: str | None = None,
+    num_workers: int = 1,
+    pool: ProcessPoolExecutor | None = None,
+) -> list[dict[str, Any]]:
+    """
+    Same as `load_ndjson_file`, served from `cache_dir` while the source is unchanged.
+
+    Without a `cache_dir` this just parses the file. `num_workers` only applies when the
+    file has to be parsed, on `pool` if given.
+    """
+    if cache_dir is None:
+        return load_ndjson_file(filepath, fields, num_workers, pool=pool)
+    source = stat(filepath)
+    check_cache_dir(cache_dir)
+    cached = cache_path(cache_dir, filepath, fields)
+    resource_list = _read_cache(cached, source.st_size, source.st_mtime_ns)
+    if resource_list is not None:
+        return resource_list
+    resource_list = load_ndjson_file(filepath, fields, num_workers, pool=pool)
+    _write_cache(cached, source.st_size, source.st_mtime_ns, resource_list)
+    return resource_list
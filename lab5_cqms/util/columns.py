@@ -0,0 +1,173 @@
+"""
+Column-oriented storage for the high-volume resource types.
+
+Rather than reading fields out of a dict per record, a `ResourceColumns` holds one
+compact `array` per field: interned patient ints, epoch-second dates and interned status
+ints. Criteria are then evaluated as byte masks over those columns (plus value set masks
+from `util.terminology`) and grouped per patient, e.g. "any completed mammogram in the
+window". Masks are built with bulk operations rather than a Python test per row: a
+status mask is a `bytes.translate` over a byte-coded status column, a date window is a
+bisect over the dates sorted once per list, and masks are combined as big-int ANDs.
+"""
+
+from array import array
+from bisect import bisect_right
+from itertools import compress
+from typing import Any
+
+from util.dates import SECONDS_PER_DAY
+from util.helpers import compile_path, get_date_column, get_derived
+from util.instrument import count
+
+
+class Interner:
+    """
+    Assigns dense int ids to strings in first-seen order (`None` is always -1)
+    """
+
+    def __init__(self) -> None:
+        self.ids: dict[str, int] = {}
+        self.values: list[str] = []
+
+    def intern(self, value: Any) -> int:
+        if value is None:
+            return -1
+        value = str(value)
+        res = self.ids.get(value)
+        if res is None:
+            res = self.ids[value] = len(self.values)
+            self.values.append(value)
+        return res
+
+    def lookup(self, value: Any) -> int:
+        """
+        Same as `intern`, without adding unseen values (-1 instead)
+        """
+        return -1 if value is None else self.ids.get(str(value), -1)
+
+
+# Shared across every column store, so ints are comparable between resource types
+PATIENT_IDS = Interner()
+STATUSES = Interner()
+
+# Which fields make up the columns for each resource type
+COLUMN_LAYOUTS: dict[str, dict[str, str]] = {
+    "Encounter": {
+        "patient_key": "subject.reference",
+        "date_key": "period.start",
+    },
+    "Procedure": {
+        "patient_key": "subject.reference",
+        "date_key": "performedPeriod.start",
+        "status_key": "status",
+    },
+    "Immunization": {
+        "patient_key": "patient.reference",
+        "date_key": "occurrenceDateTime",
+        "status_key": "status",
+    },
+    "Observation": {
+        "patient_key": "subject.reference",
+        "date_key": "effectiveDateTime",
+        "status_key": "status",
+    },
+}
+
+
+class ResourceColumns:
+    """
+    Columns for one list of resources; row `i` of every column is `resource_list[i]`
+    """
+
+    def __init__(
+        self,
+        resource_list: list[dict[str, Any]],
+        patient_key: str,
+        date_key: str,
+        status_key: str | None = None,
+    ):
+        get_reference = compile_path(patient_key)
+        self.patients = array(
+            "l",
+            (PATIENT_IDS.intern(get_reference(r).split("/")[1]) for r in resource_list),
+        )
+        self.dates = get_date_column(resource_list, date_key)
+        self.statuses = self._interned_column(resource_list, status_key, STATUSES)
+        # Status ids shifted by one (None -> 0), a byte per row, for `bytes.translate`
+        self._status_codes: bytes | None = None
+        if self.statuses is not None and len(STATUSES.values) < 255:
+            self._status_codes = bytes(s + 1 for s in self.statuses)
+        self._date_order: list[int] | None = None
+        self._sorted_dates: list[int] = []
+
+    @staticmethod
+    def _interned_column(
+        resource_list: list[dict[str, Any]], key: str | None, interner: Interner
+    ) -> array | None:
+        if key is None:
+            return None
+        return array("l", map(interner.intern, map(compile_path(key), resource_list)))
+
+    def __len__(self) -> int:
+        return len(self.patients)
+
+    def window_mask(self, start: int, end: int) -> bytearray:
+        """
+        Rows whose date is within [start, end] (see `epoch_is_within_range`)
+        """
+        if self._date_order is None:
+            # MISSING_EPOCH sorts first, below any window
+            self._date_order = sorted(range(len(self)), key=self.dates.__getitem__)
+            self._sorted_dates = [self.dates[i] for i in self._date_order]
+        lo = bisect_right(self._sorted_dates, start - SECONDS_PER_DAY)
+        hi = bisect_right(self._sorted_dates, end)
+        count(scanned=hi - lo, predicates=2)
+        mask = bytearray(len(self))
+        for i in self._date_order[lo:hi]:
+            mask[i] = 1
+        return mask
+
+    def status_mask(self, status: str) -> bytearray:
+        """
+        Rows with the given status
+        """
+        if self.statuses is None:
+            raise ValueError("No status column for these resources")
+        status_id = STATUSES.lookup(status)
+        count(scanned=len(self), predicates=len(self))
+        if status_id == -1:
+            return bytearray(len(self))
+        if self._status_codes is None:
+            return bytearray(s == status_id for s in self.statuses)
+        table = bytearray(256)
+        table[status_id + 1] = 1
+        return bytearray(self._status_codes.translate(table))
+
+    def patients_where(self, *masks: bytearray) -> set[str]:
+        """
+        Returns the ids of patients with at least one row that passes every mask
+        """
+        if masks:
+            # Masks hold 0/1 bytes, so ANDing them as ints keeps one 0/1 byte per row
+            combined = int.from_bytes(masks[0], "little")
+            for mask in masks[1:]:
+                combined &= int.from_bytes(mask, "little")
+            rows = combined.to_bytes(len(self), "little")
+            pids = set(compress(self.patients, rows))
+        else:
+            pids = set(self.patients)
+        values = PATIENT_IDS.values
+        return {values[p] for p in pids}
+
+
+def get_columns(
+    resource_list: list[dict[str, Any]], resource_type: str
+) -> ResourceColumns:
+    """
+    Returns the (shared) columns for `resource_list`, building them on first use
+    """
+    return get_derived(
+        resource_list,
+        f"columns:{resource_type}",
+        lambda rl: ResourceColumns(rl, **COLUMN_LAYOUTS[resource_type]),
+    )
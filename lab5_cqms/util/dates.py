@@ -0,0 +1,85 @@
+"""
+Date handling for the CQM runners.
+
+Timestamps are converted once into epoch seconds (UTC) so range and age checks can run
+as plain integer comparisons instead of re-parsing ISO strings on every call.
+"""
+
+from datetime import date, datetime, timedelta, timezone
+
+import arrow
+
+SECONDS_PER_DAY = 86400
+
+# Stored in date columns for resources that don't have the requested timestamp
+MISSING_EPOCH = -(2**63)
+
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+_EPOCH_DATETIME = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def _epoch_day(year: int, month: int, day: int) -> int:
+    return date(year, month, day).toordinal() - _EPOCH_ORDINAL
+
+
+def to_epoch_seconds(value: str | datetime | None) -> int:
+    """
+    Converts an ISO-8601 string or datetime into seconds since the Unix epoch.
+
+    The fixed `YYYY-MM-DD` and `YYYY-MM-DDTHH:MM:SS±hh:mm` (or `Z`) shapes emitted by
+    Synthea are parsed by slicing; anything else falls back to `arrow.get`. Naive values
+    are treated as UTC, matching `arrow`. `None` maps to MISSING_EPOCH.
+    """
+    if value is None:
+        return MISSING_EPOCH
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return (value - _EPOCH_DATETIME) // timedelta(seconds=1)
+    try:
+        if len(value) == 10 and value[4] == "-" and value[7] == "-":
+            return (
+                _epoch_day(int(value[0:4]), int(value[5:7]), int(value[8:10]))
+                * SECONDS_PER_DAY
+            )
+        if len(value) in (20, 25) and value[10] == "T" and value[13] == ":":
+            seconds = (
+                _epoch_day(int(value[0:4]), int(value[5:7]), int(value[8:10]))
+                * SECONDS_PER_DAY
+                + int(value[11:13]) * 3600
+                + int(value[14:16]) * 60
+                + int(value[17:19])
+            )
+            if len(value) == 20 and value[19] == "Z":
+                return seconds
+            if len(value) == 25 and value[19] in "+-" and value[22] == ":":
+                offset = int(value[20:22]) * 3600 + int(value[23:25]) * 60
+                return seconds - offset if value[19] == "+" else seconds + offset
+    except ValueError:
+        pass
+    return to_epoch_seconds(arrow.get(value).datetime)
+
+
+def month_of(value: str) -> int:
+    """
+    Month (1-12) of an ISO-8601 date string, read from the string itself (i.e. in its
+    own UTC offset rather than converted to UTC)
+    """
+    return int(value.split("-")[1])
+
+
+def epoch_years_between(epoch_a: int, epoch_b: int) -> float:
+    """
+    Same as `get_datediff_in_years`, for epoch seconds (i.e. whole days of b - a / 365)
+    """
+    return ((epoch_b - epoch_a) // SECONDS_PER_DAY) / 365.0
+
+
+def epoch_is_within_range(ref: int, start: int, end: int) -> bool:
+    """
+    Same as `date_is_within_date_range`, for epoch seconds.
+
+    Mirrors the whole-day rounding of the original check, so anything later than one
+    day before `start` (up to and including `end`) counts as within the range.
+    """
+    return ref != MISSING_EPOCH and start - SECONDS_PER_DAY < ref <= end
@@ -0,0 +1,144 @@
+"""
+Single-pass evaluation of several measures.
+
+Each measure that implements `BaseRunner.fused_scan` registers a handler per resource
+type plus its own per-patient accumulators (a `MeasureScan`). The engine then streams
+every NDJSON file exactly once and hands each resource to the handlers of every measure
+that reads that type, so the scan cost is O(total resources) however many measures run:
+
+    python -m util.engine ../data ./output
+
+Scans only record period-independent, per-patient facts, so `run_periods` evaluates a
+whole list of measurement periods (e.g. every quarter) from that same single pass; each
+period is then a bisect over per-patient timelines instead of another scan.
+
+Measures without a fused scan still work: the resource types they need are collected
+into lists during the same pass, and they run through `run_all` once per period.
+"""
+
+from datetime import datetime
+from os import path
+from typing import Any
+
+from util.helpers import get_patient_id
+from util.loader import get_required_fields, iter_ndjson, ndjson_path
+from util.runner import BaseRunner, ResourceHandler
+from util.sharding import Resources, Results, build_runner, drop_resource_indexes
+
+
+def scan_ndjson_dir(
+    data_dir: str,
+    handlers: dict[str, list[ResourceHandler]],
+    fields: dict[str, set[str]],
+) -> dict[str, int]:
+    """
+    Streams `<data_dir>/<type>.ndjson` (or `.ndjson.gz` / `.zst`) once per resource type
+    in `handlers`.
+
+    Every resource is projected down to `fields` and passed to each handler of its type.
+    Types without a file are skipped, as in a bulk export with no such resources.
+    Returns the number of resources scanned per type.
+    """
+    scanned = {}
+    for resource_type, type_handlers in handlers.items():
+        filepath = ndjson_path(data_dir, resource_type)
+        scanned[resource_type] = 0
+        if not path.exists(filepath):
+            continue
+        for r in iter_ndjson(filepath, fields.get(resource_type)):
+            pid = get_patient_id(resource_type, r)
+            for handle in type_handlers:
+                handle(pid, r)
+            scanned[resource_type] += 1
+    return scanned
+
+
+def _collector(resource_list: list[dict[str, Any]]) -> ResourceHandler:
+    # Handler that appends every resource it is given to `resource_list`
+    def handle(pid: str, r: dict[str, Any]) -> None:
+        resource_list.append(r)
+
+    return handle
+
+
+def run_periods(
+    runner_classes: list[type[BaseRunner]],
+    periods: list[tuple[datetime, datetime]],
+    data_dir: str,
+) -> dict[str, list[Results]]:
+    """
+    Evaluates every measure for every (start, end) period with one pass over `data_dir`.
+
+    Returns each runner's `run_all`-shaped results, one per period in the given order,
+    keyed by runner class name.
+    """
+    scans = {runner_class: runner_class.fused_scan() for runner_class in runner_classes}
+    handlers: dict[str, list[ResourceHandler]] = {}
+    for scan in scans.values():
+        if scan is not None:
+            for resource_type, handle in scan.handlers().items():
+                handlers.setdefault(resource_type, []).append(handle)
+
+    # Resource lists for the measures that can only run over lists
+    unfused = [c for c, scan in scans.items() if scan is None]
+    resources: Resources = {}
+    for resource_type in get_required_fields(unfused):
+        resource_list = resources[resource_type] = []
+        handlers.setdefault(resource_type, []).append(_collector(resource_list))
+
+    scan_ndjson_dir(data_dir, handlers, get_required_fields(runner_classes))
+
+    results: dict[str, list[Results]] = {}
+    for runner_class, scan in scans.items():
+        results[runner_class.__name__] = [
+            (
+                build_runner(runner_class, start, end, resources).run_all()
+                if scan is None
+                else scan.results(start, end)
+            )
+            for start, end in periods
+        ]
+    drop_resource_indexes(resources)
+    return results
+
+
+def run_fused(
+    runner_classes: list[type[BaseRunner]],
+    start_period: datetime,
+    end_period: datetime,
+    data_dir: str,
+    print_counts: bool = False,
+    save_to_dir: str | None = None,
+) -> list[Results]:
+    """
+    Evaluates every measure with one pass over `data_dir`; results are in the same order
+    """
+    periods = [(start_period, end_period)]
+    results = run_periods(runner_classes, periods, data_dir)
+    for runner_class in runner_classes:
+        build_runner(runner_class, start_period, end_period, {}).report(
+            results[runner_class.__name__][0],
+            print_counts=print_counts,
+            save_to_dir=save_to_dir,
+        )
+    return [results[runner_class.__name__][0] for runner_class in runner_classes]
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from deliverables import ALL_RUNNERS
+    from main import MEASUREMENT_PERIOD_END_DATETIME, MEASUREMENT_PERIOD_START_DATETIME
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("data_dir")
+    parser.add_argument("save_to_dir")
+    args = parser.parse_args()
+    run_fused(
+        ALL_RUNNERS,
+        MEASUREMENT_PERIOD_START_DATETIME,
+        MEASUREMENT_PERIOD_END_DATETIME,
+        args.data_dir,
+        print_counts=True,
+        save_to_dir=args.save_to_dir,
+    )
@@ -6,10 +6,13 @@ to prevent re-implementing logic across multiple CQM classes.
 """
 
 import re
+from array import array
+from collections import OrderedDict
 from datetime import datetime
-from typing import Any
+from functools import lru_cache
+from typing import Any, Callable
 
-import arrow
+from util.dates import epoch_is_within_range, epoch_years_between, to_epoch_seconds
 
 
 def get_datediff_in_years(date_a: str | datetime, date_b: str | datetime) -> float:
@@ -18,12 +21,7 @@ def get_datediff_in_years(date_a: str | datetime, date_b: str | datetime) -> flo
 
     I.e. the result is positive if date_b occurs after date_a, otherwise negative (barring 0.0)
     """
-    if isinstance(date_a, str):
-        date_a = arrow.get(date_a).datetime
-    if isinstance(date_b, str):
-        date_b = arrow.get(date_b).datetime
-    delta = date_b - date_a
-    return delta.days / 365.0
+    return epoch_years_between(to_epoch_seconds(date_a), to_epoch_seconds(date_b))
 
 
 def date_is_within_date_range(
@@ -32,23 +30,121 @@ def date_is_within_date_range(
     """
     Returns True if ref_date falls between start and end
     """
-    years_since_start = get_datediff_in_years(
-        ref_date, start
-    )  # Negative if ref_date is after start
-    years_since_end = get_datediff_in_years(ref_date, end)
-    return years_since_start <= 0 and years_since_end >= 0
+    return epoch_is_within_range(
+        to_epoch_seconds(ref_date), to_epoch_seconds(start), to_epoch_seconds(end)
+    )
+
+
+# Maps patient id -> positions of that patient's resources in the source list
+PatientIndex = dict[str, list[int]]
+
+
+def build_patient_index(
+    resource_list: list[dict[str, Any]], pid_reference_key: str = "subject.reference"
+) -> PatientIndex:
+    """
+    Groups the positions of `resource_list` by the patient ID in `pid_reference_key`.
+
+    Positions keep their original relative order within each patient's list, and line up
+    with the columns returned by `get_date_column`.
+    """
+    index: PatientIndex = {}
+    get_reference = compile_path(pid_reference_key)
+    for i, r in enumerate(resource_list):
+        pid = get_reference(r).split("/")[1]
+        index.setdefault(pid, []).append(i)
+    return index
+
+
+# Number of most recently used lists whose derived data `get_derived` keeps
+MAX_DERIVED_LISTS = 64
+
+# id(list) -> (list, name -> (length when built, result)), least recently used first.
+# Holding the list keeps its id from being reused while its entry exists.
+_DERIVED_CACHE: OrderedDict[
+    int, tuple[list[dict[str, Any]], dict[str, tuple[int, Any]]]
+] = OrderedDict()
+
+
+def get_derived(
+    resource_list: list[dict[str, Any]],
+    name: str,
+    build: Callable[[list[dict[str, Any]]], Any],
+) -> Any:
+    """
+    Returns `build(resource_list)`, computing it only once per list.
+
+    Results are cached on the identity of the list, so every runner given the same
+    loaded list shares them. A change in length triggers a rebuild. Only the
+    `MAX_DERIVED_LISTS` most recently used lists are kept; callers that create
+    short-lived lists release them sooner with `drop_derived`.
+    """
+    list_key = id(resource_list)
+    entry = _DERIVED_CACHE.get(list_key)
+    if entry is None:
+        entry = _DERIVED_CACHE[list_key] = (resource_list, {})
+        while len(_DERIVED_CACHE) > MAX_DERIVED_LISTS:
+            _DERIVED_CACHE.popitem(last=False)
+    else:
+        _DERIVED_CACHE.move_to_end(list_key)
+    derived = entry[1]
+    cached = derived.get(name)
+    if cached is not None and cached[0] == len(resource_list):
+        return cached[1]
+    res = build(resource_list)
+    derived[name] = (len(resource_list), res)
+    return res
+
+
+def drop_derived(resource_list: list[dict[str, Any]]) -> None:
+    """
+    Forgets everything `get_derived` built for `resource_list`, e.g. once it is replaced
+    by a reloaded list, so neither is kept alive by the cache
+    """
+    _DERIVED_CACHE.pop(id(resource_list), None)
+
+
+def get_patient_index(
+    resource_list: list[dict[str, Any]], pid_reference_key: str = "subject.reference"
+) -> PatientIndex:
+    """
+    Returns the (shared) patient index for `resource_list`, building it on first use
+    """
+    return get_derived(
+        resource_list,
+        f"patient_index:{pid_reference_key}",
+        lambda rl: build_patient_index(rl, pid_reference_key),
+    )
+
+
+def get_date_column(resource_list: list[dict[str, Any]], key: str) -> array:
+    """
+    Returns the timestamp at `key` for every resource as epoch seconds.
+
+    Each timestamp is parsed once per list; missing values hold `MISSING_EPOCH`.
+    """
+    return get_derived(
+        resource_list,
+        f"date_column:{key}",
+        lambda rl: array("q", map(to_epoch_seconds, map(compile_path(key), rl))),
+    )
 
 
 def get_resource_sublist(
     resource_list: list[dict[str, Any]],
     pid_set: set[str],
     pid_reference_key="subject.reference",
+    patient_index: PatientIndex | None = None,
 ) -> list[dict[str, Any]]:
     """
     Returns the subset of resources in `resource_list` that contain a patient ID in `pid_set`.
 
-    Checks specifically in the field denoted in `pid_reference_key`.
+    Checks specifically in the field denoted in `pid_reference_key`. If a
+    `patient_index` is given (see `get_patient_index`), each patient is an O(1) lookup
+    instead of a scan.
     """
+    if patient_index is not None:
+        return [resource_list[i] for pid in pid_set for i in patient_index.get(pid, [])]
     return [
         r
         for r in resource_list
@@ -56,6 +152,25 @@ def get_resource_sublist(
     ]
 
 
+# Resource types that point at their patient through `patient` rather than `subject`
+PATIENT_REFERENCE_KEYS = {
+    "AllergyIntolerance": "patient.reference",
+    "Device": "patient.reference",
+    "Immunization": "patient.reference",
+}
+
+
+def get_patient_id(resource_type: str, r: dict[str, Any]) -> str:
+    """
+    Gets the id of the patient `r` belongs to (its own id for a Patient)
+    """
+    if resource_type == "Patient":
+        return r["id"]
+    return get_reference_id_from_resource(
+        r, PATIENT_REFERENCE_KEYS.get(resource_type, "subject.reference")
+    )
+
+
 def get_reference_id_from_resource(
     r: dict[str, Any], key: str = "subject.reference"
 ) -> str:
@@ -64,7 +179,7 @@ def get_reference_id_from_resource(
 
     Assumes data is well-formed in the exact format: "resourceType/id"
     """
-    return nested_get(r, key).split("/")[1]
+    return compile_path(key)(r).split("/")[1]
 
 
 def nested_get(source: dict[str, Any], key: str, default: Any = None) -> Any:
@@ -74,32 +189,49 @@ def nested_get(source: dict[str, Any], key: str, default: Any = None) -> Any:
     If the dict contains an array, the correct index is expected, e.g. for a dict d:
         d.a.b[0]
       will try d['a']['b'][0], where b should be an array with at least 1 item.
+
+    For repeated lookups of the same key, prefer holding on to `compile_path(key)`.
     """
-    res = source
-    for key_part in key.split("."):
-        res = _single_get(res, key_part)
-        if res is None:
-            break
-    return res if res is not None else default
+    return compile_path(key)(source, default)
 
 
 REGEX_INDEX = re.compile(r"(.*)\[(-?\d+)\]$")
 
+PathGetter = Callable[..., Any]
+
 
-def _single_get(source: dict[str, Any], key: str, default: Any = None) -> Any:
+@lru_cache(maxsize=512)
+def compile_path(key: str) -> PathGetter:
     """
-    Gets single item, supports int indexing, e.g. `someKey[0]`
+    Parses a `nested_get` key once into a reusable `getter(source, default=None)`.
+
+    The getter behaves exactly like `nested_get(source, key, default)`, without
+    splitting the key or running `REGEX_INDEX` on every call.
     """
-    if key.endswith("]"):
-        if match := REGEX_INDEX.fullmatch(key):
-            key_part = match.group(1)
-            index_part = match.group(2)
-            values = source.get(key_part, [])
-            try:
-                return values[int(index_part)]
-            except IndexError:
-                return None
-    return source.get(key, default)
+    steps: list[tuple[str, int | None]] = []
+    for key_part in key.split("."):
+        match = REGEX_INDEX.fullmatch(key_part) if key_part.endswith("]") else None
+        if match:
+            steps.append((match.group(1), int(match.group(2))))
+        else:
+            steps.append((key_part, None))
+
+    def getter(source: dict[str, Any], default: Any = None) -> Any:
+        res: Any = source
+        for key_part, index in steps:
+            if index is None:
+                res = res.get(key_part)
+            else:
+                values = res.get(key_part, [])
+                try:
+                    res = values[index]
+                except IndexError:
+                    res = None
+            if res is None:
+                break
+        return res if res is not None else default
+
+    return getter
 
 
 """
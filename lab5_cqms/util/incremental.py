@@ -0,0 +1,185 @@
+"""
+Incremental re-evaluation as FHIR bulk-export deltas arrive.
+
+Each patient's projected resources are persisted in a `shelve` store under `state_dir`,
+keyed by patient id and then by resource id. When a delta directory arrives, its
+resources are upserted, and only the patients they touch are re-evaluated from their own
+stored history. Because every criterion is per-patient, the population sets saved under
+`save_to_dir` are then patched in place: affected patients are dropped from each set and
+the re-evaluated ones added back. Daily cost scales with the patients in the delta, not
+with the full history. The delta's patients are recorded as pending in `state.json`
+before the store is updated and cleared only once every runner has saved its results, so
+a run that fails part way re-evaluates them next time:
+
+    python -m util.incremental /exports/2023-02-16 ./state ./output
+"""
+
+import json
+import shelve
+from datetime import datetime
+from os import getpid, makedirs, path, replace
+from typing import AbstractSet, Iterable
+
+from util.helpers import get_patient_id
+from util.loader import get_required_fields, iter_ndjson, ndjson_path
+from util.runner import STAGES, BaseRunner
+from util.sharding import (
+    Resources,
+    Results,
+    build_runner,
+    drop_resource_indexes,
+    read_saved_results,
+)
+
+
+def load_delta_dir(delta_dir: str, fields: dict[str, set[str]]) -> Resources:
+    """
+    Loads whichever of the resource types in `fields` have a file in `delta_dir`
+    """
+    filepaths = {t: ndjson_path(delta_dir, t) for t in fields}
+    return {
+        resource_type: list(iter_ndjson(filepaths[resource_type], fl))
+        for resource_type, fl in fields.items()
+        if path.exists(filepaths[resource_type])
+    }
+
+
+def delta_patient_ids(delta: Resources) -> set[str]:
+    """
+    Ids of every patient with a resource in `delta`
+    """
+    return {
+        get_patient_id(resource_type, r)
+        for resource_type, resource_list in delta.items()
+        for r in resource_list
+    }
+
+
+def upsert_patient_resources(patients: shelve.Shelf, delta: Resources) -> set[str]:
+    """
+    Stores the delta's resources per patient (replacing same-id ones) and returns
+    the ids of every patient touched
+    """
+    touched: dict[str, dict[str, dict]] = {}
+    for resource_type, resource_list in delta.items():
+        for r in resource_list:
+            pid = get_patient_id(resource_type, r)
+            if pid not in touched:
+                touched[pid] = patients.get(pid, {})
+            by_id = touched[pid].setdefault(resource_type, {})
+            by_id[r.get("id") or f"#{len(by_id)}"] = r
+    for pid, record in touched.items():
+        patients[pid] = record
+    return set(touched)
+
+
+def collect_patient_resources(patients: shelve.Shelf, pids: Iterable[str]) -> Resources:
+    """
+    Gathers the stored resources of `pids` back into per-type lists
+    """
+    res: Resources = {}
+    for pid in pids:
+        for resource_type, by_id in patients.get(pid, {}).items():
+            res.setdefault(resource_type, []).extend(by_id.values())
+    return res
+
+
+def patch_stage(
+    previous: AbstractSet[str] | None,
+    partial: AbstractSet[str] | None,
+    affected: set[str],
+) -> AbstractSet[str] | None:
+    """
+    Replaces the affected patients' membership in `previous` with `partial`
+    """
+    if previous is None and partial is None:
+        return None
+    return ((previous or set()) - affected) | (partial or set())
+
+
+def _write_state(meta_path: str, period: list[str] | None, pending: set[str]) -> None:
+    # Written next to the final path and renamed, so a crash never leaves it partial
+    tmp_path = f"{meta_path}.{getpid()}.tmp"
+    with open(tmp_path, "w") as file:
+        json.dump({"period": period, "pending": sorted(pending)}, file)
+    replace(tmp_path, meta_path)
+
+
+def run_incremental(
+    runner_classes: list[type[BaseRunner]],
+    start_period: datetime,
+    end_period: datetime,
+    delta_dir: str,
+    state_dir: str,
+    save_to_dir: str,
+    print_counts: bool = False,
+) -> dict[str, Results]:
+    """
+    Applies one delta directory and updates the saved results of every runner.
+
+    The first run (or a run with a different measurement period) evaluates every stored
+    patient from scratch. Patients left pending by a failed run are re-evaluated too.
+    """
+    makedirs(state_dir, exist_ok=True)
+    makedirs(save_to_dir, exist_ok=True)
+    meta_path = f"{state_dir}/state.json"
+    period = [start_period.isoformat(), end_period.isoformat()]
+    previous_period = None
+    pending: set[str] = set()
+    if path.exists(meta_path):
+        with open(meta_path, "r") as file:
+            state = json.load(file)
+        previous_period = state["period"]
+        pending = set(state.get("pending", []))
+    from_scratch = previous_period != period
+
+    delta = load_delta_dir(delta_dir, get_required_fields(runner_classes))
+    # Recorded before the store changes, so a failure below can't lose them
+    pending |= delta_patient_ids(delta)
+    _write_state(meta_path, previous_period, pending)
+    with shelve.open(f"{state_dir}/patients") as patients:
+        affected = upsert_patient_resources(patients, delta) | pending
+        if from_scratch:
+            affected = set(patients.keys())
+        resources = collect_patient_resources(patients, affected)
+
+    results: dict[str, Results] = {}
+    for runner_class in runner_classes:
+        runner = build_runner(runner_class, start_period, end_period, resources)
+        partial = runner.run_all()
+        name = runner_class.__name__
+        previous: Results = {stage: None for stage in STAGES}
+        if not from_scratch and path.isdir(f"{save_to_dir}/{name}"):
+            previous = read_saved_results(save_to_dir, name)
+        res = {
+            stage: patch_stage(previous[stage], partial[stage], affected)
+            for stage in STAGES
+        }
+        runner.report(res, print_counts=print_counts, save_to_dir=save_to_dir)
+        results[name] = res
+    drop_resource_indexes(resources)
+
+    _write_state(meta_path, period, set())
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from deliverables import ALL_RUNNERS
+    from main import MEASUREMENT_PERIOD_END_DATETIME, MEASUREMENT_PERIOD_START_DATETIME
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("delta_dir")
+    parser.add_argument("state_dir")
+    parser.add_argument("save_to_dir")
+    args = parser.parse_args()
+    run_incremental(
+        ALL_RUNNERS,
+        MEASUREMENT_PERIOD_START_DATETIME,
+        MEASUREMENT_PERIOD_END_DATETIME,
+        args.delta_dir,
+        args.state_dir,
+        args.save_to_dir,
+        print_counts=True,
+    )
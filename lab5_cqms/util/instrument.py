@@ -0,0 +1,114 @@
+"""
+Per-stage instrumentation for the runners.
+
+`BaseRunner.enable_instrumentation` wraps every computed stage in a `StageProbe`, which
+records wall time, CPU time, net allocated blocks and the counters below, optionally
+with a cProfile and/or tracemalloc capture. Measure code (and the shared helpers it
+calls) reports its work through `count`, which is a no-op when nothing is measured.
+"""
+
+import cProfile
+import io
+import pstats
+import sys
+import time
+import tracemalloc
+from typing import Any
+
+# Counters of the stages currently being measured, innermost last
+_ACTIVE: list[dict[str, int]] = []
+# Probes with a running cProfile capture
+_PROFILING: list["StageProbe"] = []
+# Probes tracing allocations, innermost last
+_TRACING: list["StageProbe"] = []
+
+
+def count(scanned: int = 0, predicates: int = 0) -> None:
+    """
+    Adds to the resources scanned / predicate evaluations of the stage being measured
+    """
+    if _ACTIVE:
+        counters = _ACTIVE[-1]
+        counters["resources_scanned"] += scanned
+        counters["predicate_evaluations"] += predicates
+
+
+class StageProbe:
+    """
+    Context manager measuring one stage; results end up in `metrics` (and `profile`)
+    """
+
+    def __init__(self, profile: bool = False, trace_allocations: bool = False):
+        self.profile: cProfile.Profile | None = None
+        self.metrics: dict[str, Any] = {}
+        self._want_profile = profile
+        self._trace_allocations = trace_allocations
+        self._started_tracing = False
+        self._peak = 0
+        self._counters = {"resources_scanned": 0, "predicate_evaluations": 0}
+
+    def __enter__(self) -> "StageProbe":
+        # Only the outermost probe profiles, since profilers can't be nested
+        if self._want_profile and not any(p.profile for p in _PROFILING):
+            self.profile = cProfile.Profile()
+        if self._trace_allocations:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracing = True
+            self._traced_before, peak = tracemalloc.get_traced_memory()
+            if _TRACING:
+                # Otherwise the reset below erases the enclosing probe's peak so far
+                _TRACING[-1]._peak = max(_TRACING[-1]._peak, peak)
+            tracemalloc.reset_peak()
+            _TRACING.append(self)
+        _ACTIVE.append(self._counters)
+        self._blocks_before = sys.getallocatedblocks()
+        self._cpu_before = time.process_time()
+        self._wall_before = time.perf_counter()
+        if self.profile:
+            _PROFILING.append(self)
+            self.profile.enable()
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        # Probes must nest, so this one is on top; `remove` would match equal counters
+        if _ACTIVE[-1] is not self._counters:
+            raise RuntimeError("StageProbe exited while a probe it contains is active")
+        if self.profile:
+            self.profile.disable()
+            _PROFILING.remove(self)
+        wall = time.perf_counter() - self._wall_before
+        cpu = time.process_time() - self._cpu_before
+        _ACTIVE.pop()
+        self.metrics = {
+            "wall_seconds": round(wall, 6),
+            "cpu_seconds": round(cpu, 6),
+            **self._counters,
+            "allocated_blocks": sys.getallocatedblocks() - self._blocks_before,
+        }
+        if self._trace_allocations:
+            _TRACING.pop()
+            current, peak = tracemalloc.get_traced_memory()
+            # The peak since the last reset covers any nested probes too
+            peak = max(self._peak, peak)
+            self.metrics["allocated_bytes"] = current - self._traced_before
+            self.metrics["peak_traced_bytes"] = peak - self._traced_before
+            if self._started_tracing:
+                tracemalloc.stop()
+        if self.profile:
+            self.metrics["profile_top"] = top_functions(self.profile)
+
+
+def top_functions(profile: cProfile.Profile, limit: int = 15) -> list[str]:
+    """
+    The `limit` most expensive functions by cumulative time, as pstats prints them
+    """
+    stream = io.StringIO()
+    pstats.Stats(profile, stream=stream).sort_stats("cumulative").print_stats(limit)
+    lines = stream.getvalue().splitlines()
+    header = next(
+        (i for i, line in enumerate(lines) if line.lstrip().startswith("ncalls")), None
+    )
+    if header is None:
+        return []
+    return [line.rstrip() for line in lines[header:] if line.strip()]
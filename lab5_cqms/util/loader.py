@@ -0,0 +1,221 @@
+"""
+Streaming NDJSON loading with field projection.
+
+Each runner declares the fields it reads per resource type in `RESOURCE_FIELDS`.
+Resources are parsed one line at a time and trimmed down to those fields before the next
+line is read, so memory scales with the projected fields rather than the raw file size.
+
+Bulk exports may also be compressed: `.ndjson.gz` is decompressed as it is read, as is
+`.ndjson.zst` when the `zstandard` package is installed. Nothing is inflated to disk.
+With `num_workers` > 1, `load_ndjson_file` cuts the (decompressed) stream into
+line-aligned chunks of about `CHUNK_SIZE` bytes and parses them on a process pool,
+a bounded number of chunks at a time, so JSON parsing uses every core. Loaders running
+on several threads can share one such pool (see `start_parse_pool`).
+"""
+
+import gzip
+import io
+import json
+import multiprocessing
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from os import path
+from typing import Any, Iterable, Iterator
+
+from util.runner import BaseRunner
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None  # type: ignore[assignment]
+
+# NDJSON file suffixes tried, in order, for each resource type
+NDJSON_SUFFIXES = (".ndjson", ".ndjson.gz", ".ndjson.zst")
+
+# Decompressed bytes per chunk handed to a parse worker
+CHUNK_SIZE = 4 << 20
+
+# Nested field names to keep; `None` keeps the whole value at that point
+ProjectionTree = dict[str, "ProjectionTree | None"]
+
+# Always kept, regardless of what the runners declare
+ALWAYS_KEEP_FIELDS = ("id", "resourceType")
+
+
+def build_projection(fields: Iterable[str]) -> ProjectionTree:
+    """
+    Builds the projection tree for `.`-delimited `fields`, e.g. `subject.reference`.
+
+    List indices (`coding[0]`) are ignored, so every element of a list is projected the
+    same way. A shorter path wins over a longer one that it contains.
+    """
+    tree: ProjectionTree = {}
+    for field in (*ALWAYS_KEEP_FIELDS, *fields):
+        node = tree
+        parts = [part.split("[")[0] for part in field.split(".")]
+        for i, part in enumerate(parts):
+            if i == len(parts) - 1:
+                node[part] = None
+            elif part not in node:
+                node[part] = node = {}
+            elif node[part] is None:
+                break
+            else:
+                node = node[part]  # type: ignore[assignment]
+    return tree
+
+
+def project_resource(value: Any, tree: ProjectionTree | None) -> Any:
+    """
+    Returns `value` with only the fields in the projection `tree`
+    """
+    if tree is None:
+        return value
+    if isinstance(value, dict):
+        return {
+            k: project_resource(value[k], sub) for k, sub in tree.items() if k in value
+        }
+    if isinstance(value, list):
+        return [project_resource(v, tree) for v in value]
+    return value
+
+
+def ndjson_path(data_dir: str, resource_type: str) -> str:
+    """
+    Path of the (possibly compressed) NDJSON file of `resource_type` in `data_dir`.
+
+    Falls back to the plain `.ndjson` path when there is none, so callers can still
+    check for or report a missing file.
+    """
+    for suffix in NDJSON_SUFFIXES:
+        filepath = f"{data_dir}/{resource_type}{suffix}"
+        if path.exists(filepath):
+            return filepath
+    return f"{data_dir}/{resource_type}.ndjson"
+
+
+def open_ndjson(filepath: str) -> io.BufferedIOBase:
+    """
+    Opens an NDJSON file for binary reading, decompressing `.gz` / `.zst` as it is read
+    """
+    if filepath.endswith(".gz"):
+        return gzip.open(filepath, "rb")
+    if filepath.endswith(".zst"):
+        if zstandard is None:
+            raise ImportError(f"Reading {filepath} requires the zstandard package")
+        # The raw decompression reader supports neither iteration nor `readline`
+        return io.BufferedReader(zstandard.open(filepath, "rb"))
+    return open(filepath, "rb")
+
+
+def iter_ndjson(
+    filepath: str, fields: Iterable[str] | None = None
+) -> Iterator[dict[str, Any]]:
+    """
+    Yields each resource in the NDJSON file, projected down to `fields` if given
+    """
+    tree = build_projection(fields) if fields is not None else None
+    with open_ndjson(filepath) as file:
+        for line in file:
+            if line.strip():
+                yield project_resource(json.loads(line), tree)
+
+
+def iter_chunks(
+    file: io.BufferedIOBase, chunk_size: int = CHUNK_SIZE
+) -> Iterator[bytes]:
+    """
+    Yields `file` in chunks of about `chunk_size` bytes, each ending on a line break
+    """
+    while True:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            return
+        if not chunk.endswith(b"\n"):
+            chunk += file.readline()
+        yield chunk
+
+
+def parse_chunk(chunk: bytes, tree: ProjectionTree | None) -> list[dict[str, Any]]:
+    """
+    Parses every line of an NDJSON chunk, projected down to `tree`
+    """
+    return [
+        project_resource(json.loads(line), tree)
+        for line in chunk.splitlines()
+        if line.strip()
+    ]
+
+
+def start_parse_pool(num_workers: int) -> ProcessPoolExecutor:
+    """
+    Starts `num_workers` processes to parse chunks on (see `load_ndjson_file`).
+
+    Where workers are forked, they are all forked right away: create the pool before
+    starting any threads that load files with it, since forking a multi-threaded
+    process is not safe.
+    """
+    context = multiprocessing.get_context(
+        "fork" if "fork" in multiprocessing.get_all_start_methods() else None
+    )
+    pool = ProcessPoolExecutor(max_workers=num_workers, mp_context=context)
+    # With fork, the first task starts every worker
+    pool.submit(int).result()
+    return pool
+
+
+def _iter_parsed_chunks(
+    filepath: str,
+    tree: ProjectionTree | None,
+    pool: ProcessPoolExecutor,
+    num_workers: int,
+    chunk_size: int,
+) -> Iterator[list[dict[str, Any]]]:
+    # At most two chunks per worker are in flight, so memory stays bounded however
+    # large the file is. Results come back in file order.
+    with open_ndjson(filepath) as file:
+        pending: deque[Future] = deque()
+        for chunk in iter_chunks(file, chunk_size):
+            pending.append(pool.submit(parse_chunk, chunk, tree))
+            if len(pending) >= 2 * num_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def load_ndjson_file(
+    filepath: str,
+    fields: Iterable[str] | None = None,
+    num_workers: int = 1,
+    chunk_size: int = CHUNK_SIZE,
+    pool: ProcessPoolExecutor | None = None,
+) -> list[dict[str, Any]]:
+    """
+    Loads every resource in the NDJSON file, projected down to `fields` if given.
+
+    With `num_workers` > 1, chunks of the file are parsed on that many processes: those
+    of `pool` if given (see `start_parse_pool`), otherwise a pool started for this file.
+    """
+    if num_workers <= 1:
+        return list(iter_ndjson(filepath, fields))
+    if pool is None:
+        with start_parse_pool(num_workers) as own_pool:
+            return load_ndjson_file(filepath, fields, num_workers, chunk_size, own_pool)
+    tree = build_projection(fields) if fields is not None else None
+    res = []
+    for resources in _iter_parsed_chunks(filepath, tree, pool, num_workers, chunk_size):
+        res.extend(resources)
+    return res
+
+
+def get_required_fields(
+    runner_classes: Iterable[type[BaseRunner]],
+) -> dict[str, set[str]]:
+    """
+    Merges the `RESOURCE_FIELDS` declared by each runner class, keyed by resource type
+    """
+    res: dict[str, set[str]] = {}
+    for runner_class in runner_classes:
+        for resource_type, fields in runner_class.RESOURCE_FIELDS.items():
+            res.setdefault(resource_type, set()).update(fields)
+    return res
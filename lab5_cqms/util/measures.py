@@ -0,0 +1,652 @@
+"""
+Declarative measure definitions, compiled into evaluation plans.
+
+A `MeasureDefinition` lists the criteria of each population rather than code. Each
+population is nested in the one before it: the denominator within the initial
+population, and the numerator, exclusions and exceptions within the denominator
+(numerator exclusions within the numerator). Criteria come in two kinds:
+
+- patient criteria (`GenderIs`, `AgeBetween`) are vectorized over the shared
+  `PatientTable` and combined as population bitmaps
+- resource criteria (`HasResource` for "any", `LatestReadingAtMost` for "latest", and
+  `AnyOf`) are probed per candidate patient through the shared per-list indexes, i.e.
+  timelines, patient indexes and value set columns
+
+`MeasurePlan` compiles a definition once. Each population drops the criteria its parent
+population already guarantees, applies the patient criteria first and then probes the
+remaining candidates with the resource criteria, cheapest first. A probe never runs for
+a patient that a cheaper filter has already ruled out. Every criterion on the same
+resource type, date field or concept field reads the same index, whichever population
+or measure it belongs to, so each list is scanned once.
+
+`runner_for` turns a definition into a regular `BaseRunner`, which works everywhere the
+hand-written runners do (see `deliverables.definitions`).
+"""
+
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import AbstractSet, Any, Callable, Iterable
+
+import arrow
+from util.dates import epoch_is_within_range, month_of, to_epoch_seconds
+from util.helpers import (
+    PATIENT_REFERENCE_KEYS,
+    compile_path,
+    get_date_column,
+    get_derived,
+    get_patient_index,
+)
+from util.instrument import count
+from util.observations import get_component_column, get_reading_timeline
+from util.patients import Gender, PatientTable, get_patient_table
+from util.populations import population_of_ids, population_of_rows
+from util.runner import STAGES, BaseRunner
+from util.terminology import ValueSet, value_set_mask
+from util.timeline import get_monthly_timeline, get_timeline
+
+# Population each stage is evaluated within
+PARENT_STAGES = {
+    "initial_population": None,
+    "denominator": "initial_population",
+    "denominator_exclusions": "denominator",
+    "numerator": "denominator",
+    "numerator_exclusions": "numerator",
+    "denominator_exceptions": "denominator",
+}
+
+
+class Window:
+    """
+    Date range relative to the measurement period.
+
+    Each bound is the period's start / end, shifted and then replaced with `arrow`, e.g.
+    `Window(start_shift={"years": -2}, start_replace={"month": 10})` begins in October
+    two years before the period starts.
+    """
+
+    def __init__(
+        self,
+        start_shift: dict[str, int] | None = None,
+        start_replace: dict[str, int] | None = None,
+        end_shift: dict[str, int] | None = None,
+        end_replace: dict[str, int] | None = None,
+    ):
+        # Passed on to arrow as keyword arguments
+        self.start_shift: dict[str, Any] = start_shift or {}
+        self.start_replace: dict[str, Any] = start_replace or {}
+        self.end_shift: dict[str, Any] = end_shift or {}
+        self.end_replace: dict[str, Any] = end_replace or {}
+
+    def __repr__(self) -> str:
+        changes = [f"{name}={value}" for name, value in vars(self).items() if value]
+        return f"Window({', '.join(changes)})"
+
+    def bounds(self, start_period: datetime, end_period: datetime) -> tuple[int, int]:
+        """
+        Epoch seconds of the window's start and end for one period
+        """
+        start, end = start_period, end_period
+        if self.start_shift or self.start_replace:
+            start = (
+                arrow.get(start)
+                .shift(**self.start_shift)
+                .replace(**self.start_replace)
+                .datetime
+            )
+        if self.end_shift or self.end_replace:
+            end = (
+                arrow.get(end)
+                .shift(**self.end_shift)
+                .replace(**self.end_replace)
+                .datetime
+            )
+        return to_epoch_seconds(start), to_epoch_seconds(end)
+
+
+# The measurement period itself
+PERIOD = Window()
+
+
+class PlanContext:
+    """
+    Resource lists and period a plan is evaluated against
+    """
+
+    def __init__(
+        self,
+        resources: dict[str, list[dict[str, Any]]],
+        start_period: datetime,
+        end_period: datetime,
+    ):
+        self.resources = resources
+        self.start_period = start_period
+        self.end_period = end_period
+        self.start = to_epoch_seconds(start_period)
+        self.end = to_epoch_seconds(end_period)
+        self.patient_list = resources.get("Patient", [])
+        self.patients: PatientTable = get_patient_table(self.patient_list)
+        self._bounds: dict[str, tuple[int, int]] = {}
+        self._row_masks: dict[str, bytearray] = {}
+
+    def bounds(self, window: Window) -> tuple[int, int]:
+        key = repr(window)
+        if key not in self._bounds:
+            self._bounds[key] = window.bounds(self.start_period, self.end_period)
+        return self._bounds[key]
+
+    def row_mask(self, key: str, build: Callable[[], bytearray]) -> bytearray:
+        """
+        Returns the row mask of criterion `key`, built once per context, so identical
+        criteria in several populations share one scan
+        """
+        if key not in self._row_masks:
+            self._row_masks[key] = build()
+        return self._row_masks[key]
+
+
+class Criterion(ABC):
+    # Relative cost of evaluating the criterion for one patient; plans run the cheapest
+    # criteria first
+    COST = 0
+
+    def __repr__(self) -> str:
+        args = ", ".join(
+            f"{k}={v!r}"
+            for k, v in vars(self).items()
+            if v is not None and not k.startswith("_") and not k.isupper()
+        )
+        return f"{type(self).__name__}({args})"
+
+    def key(self) -> str:
+        """
+        Identifies the criterion, so a plan can skip ones its parent already applied
+        """
+        return repr(self)
+
+    @abstractmethod
+    def fields(self) -> dict[str, set[str]]:
+        """
+        Fields read per resource type (see `BaseRunner.RESOURCE_FIELDS`)
+        """
+        ...
+        raise NotImplementedError()
+
+
+class PatientCriterion(Criterion):
+    """
+    Criterion on the patient's own record, evaluated for every patient at once
+    """
+
+    @abstractmethod
+    def mask(self, context: PlanContext) -> bytearray:
+        """
+        Rows of the patient table that meet the criterion
+        """
+        ...
+        raise NotImplementedError()
+
+
+class ResourceCriterion(Criterion):
+    """
+    Criterion on the patient's resources, probed one candidate patient at a time
+    """
+
+    COST = 1
+
+    @abstractmethod
+    def holds(self, pid: str, context: PlanContext) -> bool:
+        ...
+        raise NotImplementedError()
+
+
+class GenderIs(PatientCriterion):
+    def __init__(self, gender: Gender):
+        self.gender = gender
+
+    def fields(self) -> dict[str, set[str]]:
+        return {"Patient": {"id", "gender"}}
+
+    def mask(self, context: PlanContext) -> bytearray:
+        return bytearray(g == self.gender for g in context.patients.genders)
+
+
+class AgeBetween(PatientCriterion):
+    """
+    Age at the end (or `at="start"`) of the period is within [`min_age`, `max_age`]
+    """
+
+    def __init__(
+        self,
+        min_age: float | None = None,
+        max_age: float | None = None,
+        at: str = "end",
+    ):
+        if at not in ("start", "end"):
+            raise ValueError(f"Ages are taken at the period start or end, not {at!r}")
+        self.min_age = min_age
+        self.max_age = max_age
+        self.at = at
+
+    def fields(self) -> dict[str, set[str]]:
+        return {"Patient": {"id", "birthDate"}}
+
+    def mask(self, context: PlanContext) -> bytearray:
+        low = float("-inf") if self.min_age is None else self.min_age
+        high = float("inf") if self.max_age is None else self.max_age
+        ages = context.patients.ages_at(getattr(context, self.at))
+        return bytearray(low <= age <= high for age in ages)
+
+
+def _get_statuses(resource_list: list[dict[str, Any]]) -> list[str | None]:
+    return get_derived(
+        resource_list, "statuses", lambda rl: [r.get("status") for r in rl]
+    )
+
+
+def _get_months(resource_list: list[dict[str, Any]], key: str) -> list[int]:
+    # Read from the date strings, as in `get_monthly_timeline`
+    def build(rl: list[dict[str, Any]]) -> list[int]:
+        get_date = compile_path(key)
+        return [month_of(d) if d else 0 for d in map(get_date, rl)]
+
+    return get_derived(resource_list, f"months:{key}", build)
+
+
+def _age_at_least(context: PlanContext, pid: str, time: int, min_age: float) -> bool:
+    # Patients missing from the patient list have no age, and never qualify
+    age = context.patients.age_at(pid, time)
+    return age is not None and age >= min_age
+
+
+class HasResource(ResourceCriterion):
+    """
+    Patient has at least one `resource_type` resource that passes every given filter:
+    - its `date_key` date is within `window`, in `months` and at a patient age of at
+      least `min_age`
+    - its status is `status`
+    - its CodeableConcept at `concept_key` is in `value_set`
+    """
+
+    def __init__(
+        self,
+        resource_type: str,
+        date_key: str | None = None,
+        window: Window = PERIOD,
+        months: tuple[int, ...] | None = None,
+        min_age: float | None = None,
+        status: str | None = None,
+        value_set: ValueSet | None = None,
+        concept_key: str = "code",
+    ):
+        self.resource_type = resource_type
+        self.date_key = date_key
+        self.window = window if date_key is not None else None
+        self.months = months
+        self.min_age = min_age
+        self.status = status
+        self.value_set = value_set
+        self.concept_key = concept_key if value_set is not None else None
+        self._pid_reference_key = PATIENT_REFERENCE_KEYS.get(
+            resource_type, "subject.reference"
+        )
+        if date_key is None and (months is not None or min_age is not None):
+            raise ValueError("months and min_age need a date_key")
+        # Date-only checks are a bisect on a timeline; the rest walk the patient's rows
+        self._timeline_only = (
+            date_key is not None
+            and status is None
+            and value_set is None
+            and (months is None or min_age is None)
+        )
+        self.COST = 1 if self._timeline_only else 2
+
+    def fields(self) -> dict[str, set[str]]:
+        fields = {self._pid_reference_key}
+        if self.date_key is not None:
+            fields.add(self.date_key)
+        if self.status is not None:
+            fields.add("status")
+        if self.value_set is not None:
+            fields.add(f"{self.concept_key}.coding")
+        res = {self.resource_type: fields}
+        if self.min_age is not None:
+            res["Patient"] = {"id", "birthDate"}
+        return res
+
+    def holds(self, pid: str, context: PlanContext) -> bool:
+        resource_list = context.resources.get(self.resource_type, [])
+        # `window` is set exactly when `date_key` is
+        date_key, window = self.date_key, self.window
+        if self._timeline_only and date_key is not None and window is not None:
+            start, end = context.bounds(window)
+            if self.months is not None:
+                return get_monthly_timeline(
+                    resource_list, date_key, self._pid_reference_key
+                ).any_within(pid, self.months, start, end)
+            timeline = get_timeline(resource_list, date_key, self._pid_reference_key)
+            if self.min_age is None:
+                return timeline.any_within(pid, start, end)
+            # Age only grows, so the latest event in the window decides
+            time = timeline.latest_within(pid, start, end)
+            return time is not None and _age_at_least(context, pid, time, self.min_age)
+        mask = context.row_mask(self.key(), lambda: self.row_mask(context))
+        rows = get_patient_index(resource_list, self._pid_reference_key).get(pid, [])
+        if date_key is None or self.min_age is None:
+            return any(mask[i] for i in rows)
+        dates = get_date_column(resource_list, date_key)
+        min_age = self.min_age
+        return any(
+            mask[i] and _age_at_least(context, pid, dates[i], min_age) for i in rows
+        )
+
+    def row_mask(self, context: PlanContext) -> bytearray:
+        """
+        Resources passing every filter but `min_age`, as a byte mask over the list
+        """
+        resource_list = context.resources.get(self.resource_type, [])
+        masks = []
+        if self.value_set is not None and self.concept_key is not None:
+            masks.append(
+                value_set_mask(resource_list, self.concept_key, self.value_set)
+            )
+        if self.status is not None:
+            masks.append(
+                bytearray(s == self.status for s in _get_statuses(resource_list))
+            )
+        if self.date_key is not None and self.window is not None:
+            start, end = context.bounds(self.window)
+            masks.append(
+                bytearray(
+                    epoch_is_within_range(t, start, end)
+                    for t in get_date_column(resource_list, self.date_key)
+                )
+            )
+            if self.months is not None:
+                masks.append(
+                    bytearray(
+                        m in self.months
+                        for m in _get_months(resource_list, self.date_key)
+                    )
+                )
+        count(scanned=len(resource_list), predicates=len(masks) * len(resource_list))
+        if not masks:
+            return bytearray(b"\x01") * len(resource_list)
+        return bytearray(all(keep) for keep in zip(*masks))
+
+
+class LatestReadingAtMost(ResourceCriterion):
+    """
+    The patient's latest Observation within `window` that has every component in
+    `limits` has each of them at or below its limit
+    """
+
+    COST = 3
+
+    def __init__(
+        self,
+        limits: dict[str, float],
+        date_key: str = "effectiveDateTime",
+        window: Window = PERIOD,
+    ):
+        self.limits = limits
+        self.date_key = date_key
+        self.window = window
+
+    def fields(self) -> dict[str, set[str]]:
+        return {
+            "Observation": {
+                "subject.reference",
+                self.date_key,
+                "component.code",
+                "component.valueQuantity.value",
+            }
+        }
+
+    def holds(self, pid: str, context: PlanContext) -> bool:
+        observation_list = context.resources.get("Observation", [])
+        readings = get_reading_timeline(
+            observation_list, tuple(self.limits), self.date_key
+        )
+        i = readings.latest_row_within(pid, *context.bounds(self.window))
+        return i is not None and all(
+            get_component_column(observation_list, text)[i] <= limit
+            for text, limit in self.limits.items()
+        )
+
+
+class AnyOf(ResourceCriterion):
+    """
+    At least one of `criteria` holds
+    """
+
+    def __init__(self, *criteria: ResourceCriterion):
+        self.criteria = sorted(criteria, key=lambda c: c.COST)
+        self.COST = max(c.COST for c in criteria)
+
+    def fields(self) -> dict[str, set[str]]:
+        return _merge_fields(self.criteria)
+
+    def holds(self, pid: str, context: PlanContext) -> bool:
+        return any(c.holds(pid, context) for c in self.criteria)
+
+
+def _merge_fields(criteria: Iterable[Criterion]) -> dict[str, set[str]]:
+    res: dict[str, set[str]] = {"Patient": {"id"}}
+    for criterion in criteria:
+        for resource_type, fields in criterion.fields().items():
+            res.setdefault(resource_type, set()).update(fields)
+    return res
+
+
+class MeasureDefinition:
+    """
+    Criteria of each population of a measure. Populations left as None are not
+    applicable (their stage returns None); an empty list equals the parent population.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        title: str,
+        initial_population: list[Criterion],
+        denominator: list[Criterion] | None = None,
+        denominator_exclusions: list[Criterion] | None = None,
+        numerator: list[Criterion] | None = None,
+        numerator_exclusions: list[Criterion] | None = None,
+        denominator_exceptions: list[Criterion] | None = None,
+    ):
+        self.name = name
+        self.title = title
+        self.populations: dict[str, list[Criterion] | None] = {
+            "initial_population": initial_population,
+            "denominator": [] if denominator is None else denominator,
+            "denominator_exclusions": denominator_exclusions,
+            "numerator": [] if numerator is None else numerator,
+            "numerator_exclusions": numerator_exclusions,
+            "denominator_exceptions": denominator_exceptions,
+        }
+
+
+class PopulationPlan:
+    """
+    Compiled steps of one population: patient filters, then per-candidate probes
+    """
+
+    def __init__(
+        self,
+        stage: str,
+        patient_filters: list[PatientCriterion],
+        probes: list[ResourceCriterion],
+    ):
+        self.stage = stage
+        self.parent = PARENT_STAGES[stage]
+        self.patient_filters = patient_filters
+        self.probes = probes
+
+    def evaluate(
+        self, context: PlanContext, parent: AbstractSet[str] | None
+    ) -> AbstractSet[str]:
+        patient_list = context.patient_list
+        selected: AbstractSet[str]
+        if parent is None:
+            selected = population_of_rows(patient_list, b"\x01" * len(context.patients))
+        else:
+            selected = parent
+        for criterion in self.patient_filters:
+            selected = selected & population_of_rows(
+                patient_list, criterion.mask(context)
+            )
+        if not self.probes:
+            return selected
+        count(scanned=len(selected), predicates=len(selected) * len(self.probes))
+        return population_of_ids(
+            patient_list,
+            (
+                pid
+                for pid in selected
+                if all(probe.holds(pid, context) for probe in self.probes)
+            ),
+        )
+
+
+class MeasurePlan:
+    """
+    Evaluation plan compiled from a `MeasureDefinition`
+    """
+
+    def __init__(self, definition: MeasureDefinition):
+        self.definition = definition
+        self.populations: dict[str, PopulationPlan | None] = {}
+        for stage in STAGES:
+            criteria = definition.populations[stage]
+            if criteria is None:
+                self.populations[stage] = None
+                continue
+            # The parent population already guarantees its own criteria
+            applied: set[str] = set()
+            parent = PARENT_STAGES[stage]
+            while parent is not None:
+                applied.update(c.key() for c in definition.populations[parent] or [])
+                parent = PARENT_STAGES[parent]
+            remaining = [c for c in criteria if c.key() not in applied]
+            self.populations[stage] = PopulationPlan(
+                stage,
+                sorted(
+                    (c for c in remaining if isinstance(c, PatientCriterion)),
+                    key=lambda c: c.COST,
+                ),
+                sorted(
+                    (c for c in remaining if isinstance(c, ResourceCriterion)),
+                    key=lambda c: c.COST,
+                ),
+            )
+
+    def resource_fields(self) -> dict[str, tuple[str, ...]]:
+        fields = _merge_fields(
+            c
+            for criteria in self.definition.populations.values()
+            for c in criteria or []
+        )
+        return {t: tuple(sorted(f)) for t, f in fields.items()}
+
+    def describe(self) -> str:
+        """
+        The plan's steps, one population per line
+        """
+        lines = [self.definition.name]
+        for stage, plan in self.populations.items():
+            if plan is None:
+                lines.append(f"  {stage}: N/A")
+                continue
+            steps = [plan.parent or "all patients"]
+            steps += [repr(c) for c in plan.patient_filters + plan.probes]
+            lines.append(f"  {stage}: {' -> '.join(steps)}")
+        return "\n".join(lines)
+
+
+class DefinedRunner(BaseRunner):
+    """
+    Runs the `PLAN` of a `MeasureDefinition` (see `runner_for`)
+    """
+
+    PLAN: MeasurePlan
+
+    def __init__(
+        self,
+        start_period: datetime,
+        end_period: datetime,
+        **resource_lists: list[dict[str, Any]],
+    ):
+        """
+        Takes each resource type's list as `<type>_list`, as `build_runner` passes them
+        """
+        super().__init__(start_period, end_period)
+        self.resource_lists = resource_lists
+        self._plan_context: PlanContext | None = None
+        self._plan_context_key: tuple | None = None
+        for name, resource_list in resource_lists.items():
+            setattr(self, name, resource_list)
+
+    def _evaluate(self, stage: str) -> AbstractSet[str]:
+        plan = self.PLAN.populations[stage]
+        # Only the optional populations may have no plan (see `MeasureDefinition`)
+        assert plan is not None
+        parent = None if plan.parent is None else getattr(self, plan.parent)()
+        return plan.evaluate(self._context(), parent)
+
+    def _evaluate_optional(self, stage: str) -> AbstractSet[str] | None:
+        if self.PLAN.populations[stage] is None:
+            return None
+        return self._evaluate(stage)
+
+    def _context(self) -> PlanContext:
+        # One context per period and inputs, so the stages share its row masks
+        cache_key = self._current_cache_key()
+        if self._plan_context is None or self._plan_context_key != cache_key:
+            self._plan_context = PlanContext(
+                {
+                    resource_type: self.resource_lists.get(
+                        f"{resource_type.lower()}_list", []
+                    )
+                    for resource_type in self.RESOURCE_FIELDS
+                },
+                self.start_period,
+                self.end_period,
+            )
+            self._plan_context_key = cache_key
+        return self._plan_context
+
+    def initial_population(self) -> AbstractSet[str]:
+        return self._evaluate("initial_population")
+
+    def denominator(self) -> AbstractSet[str]:
+        return self._evaluate("denominator")
+
+    def denominator_exclusions(self) -> AbstractSet[str] | None:
+        return self._evaluate_optional("denominator_exclusions")
+
+    def numerator(self) -> AbstractSet[str]:
+        return self._evaluate("numerator")
+
+    def numerator_exclusions(self) -> AbstractSet[str] | None:
+        return self._evaluate_optional("numerator_exclusions")
+
+    def denominator_exceptions(self) -> AbstractSet[str] | None:
+        return self._evaluate_optional("denominator_exceptions")
+
+
+def runner_for(definition: MeasureDefinition) -> type[DefinedRunner]:
+    """
+    Compiles `definition` into a runner class named `<name>Runner`
+    """
+    plan = MeasurePlan(definition)
+    return type(
+        f"{definition.name}Runner",
+        (DefinedRunner,),
+        {
+            "__doc__": definition.title,
+            "__module__": __name__,
+            "PLAN": plan,
+            "RESOURCE_FIELDS": plan.resource_fields(),
+        },
+    )
@@ -0,0 +1,73 @@
+"""
+Numeric component columns and latest-reading lookups for Observations.
+
+Vitals such as blood pressure are panels whose values sit in `component` entries. Rather
+than searching every Observation's components per query, each requested component is
+extracted once per loaded list into an `array` of floats (NaN where absent), and the
+Observations that carry every requested component get a per-patient `TimelineIndex`.
+The latest qualifying reading of a patient in a window is then a bisect plus a couple of
+array reads.
+"""
+
+from array import array
+from typing import Any
+
+from util.helpers import get_date_column, get_derived, get_patient_index
+from util.timeline import TimelineIndex
+
+BLOOD_PRESSURE_COMPONENTS = ("Systolic Blood Pressure", "Diastolic Blood Pressure")
+
+
+def component_value(observation: dict[str, Any], text: str) -> float:
+    """
+    Value of the (last) component of `observation` with code text `text`.
+
+    NaN if there is no such component or it has no value (e.g. a `dataAbsentReason`).
+    """
+    value = None
+    for c in observation.get("component") or []:
+        if (c.get("code") or {}).get("text") == text:
+            value = (c.get("valueQuantity") or {}).get("value")
+    return float("nan") if value is None else float(value)
+
+
+def get_component_column(observation_list: list[dict[str, Any]], text: str) -> array:
+    """
+    Returns the (shared) value of the component with code text `text`, per Observation.
+
+    NaN marks Observations without that component (or without a value for it).
+    """
+    return get_derived(
+        observation_list,
+        f"component_column:{text}",
+        lambda ol: array("d", (component_value(o, text) for o in ol)),
+    )
+
+
+def get_reading_timeline(
+    observation_list: list[dict[str, Any]],
+    components: tuple[str, ...],
+    date_key: str = "effectiveDateTime",
+) -> TimelineIndex:
+    """
+    Returns the (shared) per-patient timeline of Observations that have a value for
+    every one of `components`.
+
+    `latest_row_within` on it gives the position of the latest such reading in
+    `observation_list`, whose values are in `get_component_column`.
+    """
+
+    def build(ol: list[dict[str, Any]]) -> TimelineIndex:
+        columns = [get_component_column(ol, text) for text in components]
+        complete = [all(v == v for v in values) for values in zip(*columns)]
+        return TimelineIndex(
+            get_date_column(ol, date_key),
+            (
+                (pid, [i for i in rows if complete[i]])
+                for pid, rows in get_patient_index(ol).items()
+            ),
+        )
+
+    return get_derived(
+        observation_list, f"reading_timeline:{date_key}:{components}", build
+    )
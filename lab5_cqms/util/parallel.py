@@ -0,0 +1,68 @@
+"""
+Runs several measures concurrently on a process pool.
+
+Workers are forked after the resources are loaded, so they read the parent's lists (and
+any columns or indexes already built) through copy-on-write shared memory instead of
+having them pickled over. Only the population sets travel back, and the parent prints
+and saves them in the original order so the output matches a sequential run.
+Instrumented runners also send back their stage metrics, but not cProfile captures.
+"""
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import AbstractSet, Any
+
+from util.runner import BaseRunner
+
+# Set in the parent right before forking; workers inherit it rather than unpickling it
+_FORKED_RUNNERS: list[BaseRunner] = []
+
+
+def _run_forked(
+    index: int,
+) -> tuple[dict[str, AbstractSet[str] | None], dict[str, Any]]:
+    runner = _FORKED_RUNNERS[index]
+    res = runner.run_all()
+    return res, {
+        "stage_metrics": runner.stage_metrics,
+        "stage_stats": runner.stage_stats,
+    }
+
+
+def run_runners(
+    runners: list[BaseRunner],
+    num_workers: int = 1,
+    print_counts: bool = False,
+    save_to_dir: str | None = None,
+) -> list[dict[str, AbstractSet[str] | None]]:
+    """
+    Calls `run_all` on every runner and returns the results in the same order.
+
+    With `num_workers` > 1 the runners are spread over a forked process pool. Platforms
+    without `fork` fall back to running sequentially.
+    """
+    global _FORKED_RUNNERS
+    if (
+        num_workers > 1
+        and len(runners) > 1
+        and "fork" in multiprocessing.get_all_start_methods()
+    ):
+        _FORKED_RUNNERS = list(runners)
+        try:
+            with ProcessPoolExecutor(
+                max_workers=min(num_workers, len(runners)),
+                mp_context=multiprocessing.get_context("fork"),
+            ) as pool:
+                outcomes = list(pool.map(_run_forked, range(len(runners))))
+        finally:
+            _FORKED_RUNNERS = []
+        results = []
+        for runner, (res, stats) in zip(runners, outcomes):
+            runner.stage_metrics = stats["stage_metrics"]
+            runner.stage_stats = stats["stage_stats"]
+            results.append(res)
+    else:
+        results = [runner.run_all() for runner in runners]
+    for runner, res in zip(runners, results):
+        runner.report(res, print_counts=print_counts, save_to_dir=save_to_dir)
+    return results
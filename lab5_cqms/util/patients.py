@@ -0,0 +1,142 @@
+"""
+Compact patient records and shared age helpers.
+
+Measures only need a patient's id, gender and birth date, and mostly ask for ages. A
+`Patient` is a slotted record holding those three, with the birth date in epoch days
+and gender as a small enum. A `PatientTable` holds the same for a whole patient list as
+arrays, built once per loaded list, with vectorized ages that are computed once per
+date and shared by every measure (e.g. the age at the end of the measurement period).
+
+Ages match `epoch_years_between`: whole days elapsed divided by 365. FHIR birth dates
+are plain dates, so storing them in days loses nothing.
+"""
+
+from array import array
+from collections import OrderedDict
+from enum import IntEnum
+from typing import Any, Iterable
+
+from util.dates import MISSING_EPOCH, SECONDS_PER_DAY, to_epoch_seconds
+from util.helpers import compile_path, get_derived
+
+# Birth day of patients without a (parsable) birthDate
+MISSING_DAY = MISSING_EPOCH // SECONDS_PER_DAY
+
+# Dates whose ages a `PatientTable` keeps. Measures share a handful (e.g. the period
+# end); a long-lived table asked about many periods would otherwise grow per date.
+MAX_CACHED_AGES = 8
+
+
+class Gender(IntEnum):
+    # Administrative gender codes from FHIR
+    UNKNOWN = 0
+    FEMALE = 1
+    MALE = 2
+    OTHER = 3
+
+    @classmethod
+    def parse(cls, value: str | None) -> "Gender":
+        return cls.UNKNOWN if value is None else _GENDERS.get(value, cls.UNKNOWN)
+
+
+_GENDERS = {g.name.lower(): g for g in Gender}
+
+
+def _birth_day(birthdate: str | None) -> int:
+    seconds = to_epoch_seconds(birthdate)
+    return MISSING_DAY if seconds == MISSING_EPOCH else seconds // SECONDS_PER_DAY
+
+
+def _age(birth_day: int, time: int) -> float:
+    return (time // SECONDS_PER_DAY - birth_day) / 365.0
+
+
+class Patient:
+    """
+    Id, gender and birth date (in epoch days) of one patient
+    """
+
+    __slots__ = ("id", "gender", "birth_day")
+
+    def __init__(self, id: str, gender: Gender, birth_day: int):
+        self.id = id
+        self.gender = gender
+        self.birth_day = birth_day
+
+    @classmethod
+    def from_resource(cls, patient: dict[str, Any]) -> "Patient":
+        return cls(
+            # As in `util.helpers.get_patient_id`
+            patient["id"],
+            Gender.parse(patient.get("gender")),
+            _birth_day(patient.get("birthDate")),
+        )
+
+    def age_at(self, time: int) -> float:
+        """
+        Age in years at `time` (epoch seconds)
+        """
+        return _age(self.birth_day, time)
+
+
+class PatientTable:
+    """
+    Ids, genders and birth days of a patient list, row `i` being `patient_list[i]`
+    """
+
+    def __init__(self, patient_list: list[dict[str, Any]]):
+        self.ids: list[str] = list(map(compile_path("id"), patient_list))
+        self.genders = array("b", (Gender.parse(p.get("gender")) for p in patient_list))
+        self.birth_days = array(
+            "q", (_birth_day(p.get("birthDate")) for p in patient_list)
+        )
+        self.rows = {pid: i for i, pid in enumerate(self.ids)}
+        self._ages: OrderedDict[int, array] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def ages_at(self, time: int) -> array:
+        """
+        Every patient's age at `time` (epoch seconds), shared while `time` is among the
+        `MAX_CACHED_AGES` most recently asked for
+        """
+        ages = self._ages.get(time)
+        if ages is not None:
+            self._ages.move_to_end(time)
+            return ages
+        day = time // SECONDS_PER_DAY
+        ages = self._ages[time] = array(
+            "d", ((day - b) / 365.0 for b in self.birth_days)
+        )
+        while len(self._ages) > MAX_CACHED_AGES:
+            self._ages.popitem(last=False)
+        return ages
+
+    def age_at(self, pid: str, time: int) -> float | None:
+        """
+        Age of one patient at `time`, or None for an unknown id
+        """
+        i = self.rows.get(pid)
+        return None if i is None else _age(self.birth_days[i], time)
+
+    def ages_at_events(self, events: Iterable[tuple[str, int]]) -> array:
+        """
+        Age of each (patient id, epoch seconds) event's patient at its time (NaN for
+        unknown ids)
+        """
+        nan = float("nan")
+        return array(
+            "d",
+            (
+                nan if i is None else _age(self.birth_days[i], time)
+                for i, time in ((self.rows.get(pid), time) for pid, time in events)
+            ),
+        )
+
+
+def get_patient_table(patient_list: list[dict[str, Any]]) -> PatientTable:
+    """
+    Returns the (shared) `PatientTable` for `patient_list`, building it on first use
+    """
+    return get_derived(patient_list, "patient_table", PatientTable)
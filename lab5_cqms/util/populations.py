@@ -0,0 +1,198 @@
+"""
+Population sets as bitmaps over dense patient indices.
+
+Each patient id gets a dense index from a `PatientUniverse`: the ids of a loaded patient
+list come first, in list order, and ids seen elsewhere are appended as they come up. A
+`PopulationSet` stores a population as an int bitmap over those indices, one bit per
+patient, so set algebra between populations of the same universe (e.g. numerator ∩
+denominator − exclusions) is a single big-int operation and counting is a popcount.
+
+A `PopulationSet` is a read-only `collections.abc.Set` of id strings, so code that only
+iterates, counts or tests membership works unchanged. Ids are only materialized when the
+set is iterated, e.g. when `BaseRunner.report` writes the results.
+"""
+
+from collections.abc import Set
+from itertools import compress
+from typing import AbstractSet, Any, Iterable, Iterator
+
+from util.helpers import get_derived
+from util.patients import get_patient_table
+
+# Byte masks to binary digits (0 -> "0", anything else -> "1") and back
+_TO_DIGITS = bytes([48] + [49] * 255)
+_FROM_DIGITS = bytes.maketrans(b"01", b"\x00\x01")
+
+
+def _pack(mask: bytes | bytearray) -> int:
+    # Bit i of the result is mask[i]; int() reads the most significant digit first
+    return int(mask.translate(_TO_DIGITS)[::-1], 2) if mask else 0
+
+
+def _unpack(bits: int) -> bytes:
+    # One byte (0 or 1) per bit, up to the highest set bit
+    return bin(bits)[:1:-1].encode().translate(_FROM_DIGITS)
+
+
+class PatientUniverse:
+    """
+    Dense index of every patient id, in first-seen order
+    """
+
+    def __init__(self, ids: Iterable[str] = ()):
+        self.ids: list[str] = []
+        self.index: dict[str, int] = {}
+        for pid in ids:
+            self.intern(pid)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def intern(self, pid: str) -> int:
+        i = self.index.get(pid)
+        if i is None:
+            i = self.index[pid] = len(self.ids)
+            self.ids.append(pid)
+        return i
+
+
+class PopulationSet(Set):
+    """
+    Set of patient ids, stored as a bitmap over the indices of a `PatientUniverse`
+    """
+
+    __slots__ = ("universe", "bits", "_members")
+
+    def __init__(self, universe: PatientUniverse, bits: int = 0):
+        self.universe = universe
+        self.bits = bits
+        self._members: bytes | None = None
+
+    @classmethod
+    def from_mask(
+        cls, universe: PatientUniverse, mask: bytes | bytearray
+    ) -> "PopulationSet":
+        """
+        Patients whose index is set in `mask`, a byte per index of `universe`
+        """
+        return cls(universe, _pack(mask))
+
+    @classmethod
+    def from_ids(cls, universe: PatientUniverse, ids: Iterable[str]) -> "PopulationSet":
+        """
+        Patients with the given ids; ids new to `universe` are added to it
+        """
+        indices = [universe.intern(pid) for pid in ids]
+        mask = bytearray(len(universe))
+        for i in indices:
+            mask[i] = 1
+        return cls.from_mask(universe, mask)
+
+    @classmethod
+    def _from_iterable(cls, it: Iterable[Any]) -> set[Any]:
+        # Results of `Set` mixin operations with anything but a population of the same
+        # universe are plain sets
+        return set(it)
+
+    def _members_mask(self) -> bytes:
+        if self._members is None:
+            self._members = _unpack(self.bits)
+        return self._members
+
+    def _is_compatible(self, other: Any) -> bool:
+        return isinstance(other, PopulationSet) and other.universe is self.universe
+
+    def __len__(self) -> int:
+        return self.bits.bit_count()
+
+    def __contains__(self, pid: Any) -> bool:
+        i = self.universe.index.get(pid)
+        members = self._members_mask()
+        return i is not None and i < len(members) and members[i] == 1
+
+    def __iter__(self) -> Iterator[str]:
+        return compress(self.universe.ids, self._members_mask())
+
+    def __eq__(self, other: Any) -> bool:
+        if self._is_compatible(other):
+            return self.bits == other.bits
+        return super().__eq__(other)
+
+    def __and__(self, other: Any) -> AbstractSet[str]:
+        if self._is_compatible(other):
+            return PopulationSet(self.universe, self.bits & other.bits)
+        return super().__and__(other)
+
+    def __or__(self, other: Any) -> AbstractSet[str]:
+        if self._is_compatible(other):
+            return PopulationSet(self.universe, self.bits | other.bits)
+        return super().__or__(other)
+
+    def __sub__(self, other: Any) -> AbstractSet[str]:
+        if self._is_compatible(other):
+            return PopulationSet(self.universe, self.bits & ~other.bits)
+        return super().__sub__(other)
+
+    def __xor__(self, other: Any) -> AbstractSet[str]:
+        if self._is_compatible(other):
+            return PopulationSet(self.universe, self.bits ^ other.bits)
+        return super().__xor__(other)
+
+    def __repr__(self) -> str:
+        return f"PopulationSet({len(self)} of {len(self.universe)} patients)"
+
+
+def get_universe(patient_list: list[dict[str, Any]]) -> PatientUniverse:
+    """
+    Returns the (shared) universe of `patient_list`, whose ids come first in list order
+    """
+    return get_derived(
+        patient_list,
+        "patient_universe",
+        lambda pl: PatientUniverse(get_patient_table(pl).ids),
+    )
+
+
+def population_of_ids(
+    patient_list: list[dict[str, Any]], ids: Iterable[str]
+) -> PopulationSet:
+    """
+    Population of the given patient ids, over the universe of `patient_list`
+    """
+    return PopulationSet.from_ids(get_universe(patient_list), ids)
+
+
+def population_of_rows(
+    patient_list: list[dict[str, Any]], mask: bytes | bytearray
+) -> PopulationSet:
+    """
+    Population of the patients whose rows of `patient_list` are set in `mask`
+    """
+    patients = get_patient_table(patient_list)
+    if len(patients.rows) < len(patients):
+        # Repeated ids share an index, so rows and indices no longer line up
+        return population_of_ids(patient_list, compress(patients.ids, mask))
+    return PopulationSet.from_mask(get_universe(patient_list), mask)
+
+
+def performance_rate(res: dict[str, AbstractSet[str] | None]) -> float | None:
+    """
+    Performance rate of `run_all`-shaped results: the share of the denominator, less
+    exclusions and exceptions, that is in the numerator and not excluded from it.
+
+    None when no patient is left in the denominator.
+    """
+    eligible = res["denominator"]
+    if eligible is None:
+        return None
+    for stage in ("denominator_exclusions", "denominator_exceptions"):
+        removed = res[stage]
+        if removed is not None:
+            eligible = eligible - removed
+    if not eligible:
+        return None
+    met = (res["numerator"] or set()) & eligible
+    excluded = res["numerator_exclusions"]
+    if excluded is not None:
+        met = met - excluded
+    return len(met) / len(eligible)
@@ -1,19 +1,139 @@
 import json
 from abc import ABC, abstractmethod
 from datetime import datetime
+from functools import wraps
 from os import mkdir
-from typing import Any
+from typing import AbstractSet, Any, Callable
+
+from util.instrument import StageProbe
+from util.populations import performance_rate
+
+STAGES = (
+    "initial_population",
+    "denominator",
+    "denominator_exclusions",
+    "numerator",
+    "numerator_exclusions",
+    "denominator_exceptions",
+)
+
+
+def _cached_stage(
+    method: Callable[["BaseRunner"], AbstractSet[str] | None]
+) -> Callable[["BaseRunner"], AbstractSet[str] | None]:
+    """
+    Wraps a population stage so its result is served from the runner's stage cache
+    """
+
+    @wraps(method)
+    def wrapper(self: "BaseRunner") -> AbstractSet[str] | None:
+        return self._get_stage(method.__name__, lambda: method(self))
+
+    return wrapper
 
 
 class BaseRunner(ABC):
+    # Fields read per resource type, e.g. {"Encounter": ("period.start", ...)}.
+    # Used by `util.loader` to project resources down at load time.
+    RESOURCE_FIELDS: dict[str, tuple[str, ...]] = {}
+
     def __init__(
         self, start_period: datetime, end_period: datetime, *args: Any, **kwargs: Any
     ):
         self.start_period = start_period
         self.end_period = end_period
+        self.stage_stats: dict[str, dict[str, int]] = {}
+        self.stage_metrics: dict[str, dict[str, Any]] = {}
+        self._stage_cache: dict[str, AbstractSet[str] | None] = {}
+        self._stage_cache_key: tuple | None = None
+        self._stage_profiles: dict[str, Any] = {}
+        self._instrumentation: dict[str, bool] | None = None
+
+    def __init_subclass__(cls, **kwargs: Any):
+        """
+        Memoizes every population stage a subclass implements.
+
+        Stages call each other (e.g. `numerator` calls `denominator`), so without this
+        the initial population would be recomputed several times per `run_all`.
+        """
+        super().__init_subclass__(**kwargs)
+        for stage in STAGES:
+            if stage in cls.__dict__:
+                setattr(cls, stage, _cached_stage(cls.__dict__[stage]))
+
+    def _current_cache_key(self) -> tuple:
+        """
+        Identifies the period and input lists the cached stages were computed from
+        """
+        inputs = tuple(
+            (name, id(value), len(value))
+            for name, value in vars(self).items()
+            if isinstance(value, list)
+        )
+        return (self.start_period, self.end_period, inputs)
+
+    def _get_stage(
+        self, stage: str, compute: Callable[[], AbstractSet[str] | None]
+    ) -> AbstractSet[str] | None:
+        """
+        Returns the cached result for `stage`, computing it on a miss.
+
+        The whole cache is dropped whenever the period or any input list changes.
+        """
+        cache_key = self._current_cache_key()
+        if cache_key != self._stage_cache_key:
+            self._stage_cache = {}
+            self._stage_cache_key = cache_key
+        stats = self.stage_stats.setdefault(stage, {"hits": 0, "misses": 0})
+        if stage in self._stage_cache:
+            stats["hits"] += 1
+            return self._stage_cache[stage]
+        stats["misses"] += 1
+        if self._instrumentation is None:
+            res = compute()
+        else:
+            with StageProbe(**self._instrumentation) as probe:
+                res = compute()
+            self.stage_metrics[stage] = probe.metrics
+            if probe.profile:
+                self._stage_profiles[stage] = probe.profile
+        self._stage_cache[stage] = res
+        return res
+
+    def enable_instrumentation(
+        self, profile: bool = False, trace_allocations: bool = False
+    ) -> None:
+        """
+        Measures every stage computed from now on (see `util.instrument`).
+
+        Metrics are kept in `stage_metrics` and saved by `report` as
+        `instrumentation.json` next to the results, plus `<stage>.prof` files when
+        `profile` is set. `trace_allocations` adds tracemalloc byte counts.
+        """
+        self._instrumentation = {
+            "profile": profile,
+            "trace_allocations": trace_allocations,
+        }
+
+    @classmethod
+    def fused_scan(cls) -> "MeasureScan | None":
+        """
+        Returns this measure's single-pass state for `util.engine`, if it has one
+        """
+        return None
+
+    def clear_stage_cache(self) -> None:
+        """
+        Drops all cached stage results and resets the hit/miss counts
+        """
+        self._stage_cache = {}
+        self._stage_cache_key = None
+        self.stage_stats = {}
+        self.stage_metrics = {}
+        self._stage_profiles = {}
 
     @abstractmethod
-    def initial_population(self) -> set[str]:
+    def initial_population(self) -> AbstractSet[str]:
         """
         Returns the set of patient id values
 
@@ -23,7 +143,7 @@ class BaseRunner(ABC):
         raise NotImplementedError()
 
     @abstractmethod
-    def denominator(self) -> set[str]:
+    def denominator(self) -> AbstractSet[str]:
         """
         Returns the set of patient id values
 
@@ -33,7 +153,7 @@ class BaseRunner(ABC):
         raise NotImplementedError()
 
     @abstractmethod
-    def denominator_exclusions(self) -> set[str] | None:
+    def denominator_exclusions(self) -> AbstractSet[str] | None:
         """
         Returns the set of patient id values (if applicable, else None)
 
@@ -43,7 +163,7 @@ class BaseRunner(ABC):
         raise NotImplementedError()
 
     @abstractmethod
-    def numerator(self) -> set[str]:
+    def numerator(self) -> AbstractSet[str]:
         """
         Returns the set of patient id values
 
@@ -53,7 +173,7 @@ class BaseRunner(ABC):
         raise NotImplementedError()
 
     @abstractmethod
-    def numerator_exclusions(self) -> set[str] | None:
+    def numerator_exclusions(self) -> AbstractSet[str] | None:
         """
         Returns the set of patient id values (if applicable, else None)
 
@@ -63,7 +183,7 @@ class BaseRunner(ABC):
         raise NotImplementedError()
 
     @abstractmethod
-    def denominator_exceptions(self) -> set[str] | None:
+    def denominator_exceptions(self) -> AbstractSet[str] | None:
         """
         Returns the set of patient id values (if applicable, else None)
 
@@ -74,7 +194,7 @@ class BaseRunner(ABC):
 
     def run_all(
         self, print_counts: bool = False, save_to_dir: str | None = None
-    ) -> dict[str, set[str] | None]:
+    ) -> dict[str, AbstractSet[str] | None]:
         """Runs all of the results and returns as a dict"""
         res = {
             "initial_population": self.initial_population(),
@@ -84,10 +204,22 @@ class BaseRunner(ABC):
             "numerator_exclusions": self.numerator_exclusions(),
             "denominator_exceptions": self.denominator_exceptions(),
         }
+        self.report(res, print_counts=print_counts, save_to_dir=save_to_dir)
+        return res
+
+    def report(
+        self,
+        res: dict[str, AbstractSet[str] | None],
+        print_counts: bool = False,
+        save_to_dir: str | None = None,
+    ) -> None:
+        """Prints and/or saves results in the shape returned by `run_all`"""
         if print_counts:
             print(f"🖥️  Printing results for: {type(self).__name__}")
             for k, v in res.items():
                 print(f"\t{k}: {len(v) if v else None}")
+            rate = performance_rate(res)
+            print(f"\tperformance_rate: {None if rate is None else round(rate, 4)}")
         if save_to_dir:
             try:
                 mkdir(save_to_dir)
@@ -107,4 +239,53 @@ class BaseRunner(ABC):
                     else:
                         file.write("null")
                     file.write("\n")
-        return res
+            if self.stage_metrics:
+                self.save_instrumentation(f"{save_to_dir}/{type(self).__name__}")
+
+    def save_instrumentation(self, cqm_dir: str) -> None:
+        """
+        Writes `instrumentation.json` (and any stage profiles) into `cqm_dir`
+        """
+        with open(f"{cqm_dir}/instrumentation.json", "w") as file:
+            instrumentation = {
+                "runner": type(self).__name__,
+                "stages": self.stage_metrics,
+                "stage_cache": self.stage_stats,
+            }
+            file.write(json.dumps(instrumentation, indent=2))
+            file.write("\n")
+        for stage, profile in self._stage_profiles.items():
+            profile.dump_stats(f"{cqm_dir}/{stage}.prof")
+
+
+# Called with the patient id and the (projected) resource
+ResourceHandler = Callable[[str, dict[str, Any]], None]
+
+
+class MeasureScan(ABC):
+    """
+    Per-patient accumulators for one measure, fed by `util.engine` during a single pass.
+
+    Handlers may see resource types (and resources) in any order, so they only record
+    per-patient facts, independent of the measurement period (dated facts go into
+    `util.timeline.PatientTimelines`). The populations for any period are then derived
+    from those facts in `results`, so one pass serves many periods.
+    """
+
+    @abstractmethod
+    def handlers(self) -> dict[str, ResourceHandler]:
+        """
+        Returns the handler to call for every resource of each resource type
+        """
+        ...
+        raise NotImplementedError()
+
+    @abstractmethod
+    def results(
+        self, start_period: datetime, end_period: datetime
+    ) -> dict[str, AbstractSet[str] | None]:
+        """
+        Returns the populations for one period, in the shape returned by `run_all`
+        """
+        ...
+        raise NotImplementedError()
@@ -0,0 +1,287 @@
+"""
+Long-lived measure server that keeps loaded resources and their indexes warm.
+
+    python -m util.server ../data --port 8765
+
+The data directory is loaded once and every measure runs once at startup, which builds
+the shared indexes (`util.helpers.get_derived`). Requests are then answered from memory
+over local HTTP:
+
+    GET  /measures                                  names of the measures served
+    GET  /run?measure=CMS165v11Runner&start=2019-01-01&end=2020-01-01
+    GET  /run?quarter=2019Q4                        every measure for one quarter
+    POST /reload                                    re-check the data files right away
+
+`measure` may be repeated and defaults to every measure. Without `start`/`end` or
+`quarter` the server's default period is used, and `ids=1` adds each population's
+patient ids to the counts. Before each request the data files are stat'ed, and only
+those whose size or mtime changed are reloaded. Indexes built on a replaced list are
+dropped with it. Runners are kept per (measure, period), so a repeated query is served
+from their stage caches until a file it reads changes.
+"""
+
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import stat
+from typing import Any
+from urllib.parse import parse_qs, urlparse
+
+import arrow
+from util.cache import load_ndjson_cached
+from util.helpers import drop_derived
+from util.loader import get_required_fields, ndjson_path
+from util.populations import performance_rate
+from util.runner import BaseRunner
+from util.sharding import Resources, Results, build_runner
+
+QUARTER = re.compile(r"^(\d{4})-?Q([1-4])$")
+
+
+def parse_period(
+    query: dict[str, list[str]], default: tuple[datetime, datetime]
+) -> tuple[datetime, datetime]:
+    """
+    Period of a `/run` query: `quarter=YYYYQn`, or `start` and `end` dates
+    """
+    if "quarter" in query:
+        match = QUARTER.match(query["quarter"][0])
+        if match is None:
+            raise ValueError(f"Invalid quarter: {query['quarter'][0]}")
+        start = arrow.get(int(match[1]), 3 * int(match[2]) - 2, 1)
+        return start.datetime, start.shift(months=3).datetime
+    if "start" in query or "end" in query:
+        if "start" not in query or "end" not in query:
+            raise ValueError("Both start and end are required")
+        # arrow's ParserError is a ValueError
+        return (
+            arrow.get(query["start"][0]).datetime,
+            arrow.get(query["end"][0]).datetime,
+        )
+    return default
+
+
+def summarize(res: Results, with_ids: bool = False) -> dict[str, Any]:
+    """
+    JSON-ready counts (and optionally ids) of `run_all`-shaped results
+    """
+    summary: dict[str, Any] = {
+        "counts": {k: None if v is None else len(v) for k, v in res.items()},
+        "performance_rate": performance_rate(res),
+    }
+    if with_ids:
+        summary["populations"] = {
+            k: None if v is None else sorted(v) for k, v in res.items()
+        }
+    return summary
+
+
+class MeasureServer:
+    """
+    Resources of `data_dir` kept in memory, with runners reused per (measure, period)
+    """
+
+    def __init__(
+        self,
+        data_dir: str,
+        runner_classes: list[type[BaseRunner]],
+        default_period: tuple[datetime, datetime],
+        cache_dir: str | None = None,
+        max_runners: int = 64,
+    ):
+        self.data_dir = data_dir
+        self.runner_classes = {c.__name__: c for c in runner_classes}
+        self.default_period = default_period
+        self.cache_dir = cache_dir
+        self.max_runners = max_runners
+        self.fields = get_required_fields(runner_classes)
+        self.resources: Resources = {}
+        self._signatures: dict[str, tuple[int, int] | None] = {}
+        self._runners: OrderedDict[
+            tuple[str, datetime, datetime], BaseRunner
+        ] = OrderedDict()
+        # Indexes and stage caches are not thread-safe, so requests run one at a time
+        self._lock = threading.Lock()
+
+    def _signature(self, filepath: str) -> tuple[int, int] | None:
+        try:
+            st = stat(filepath)
+        except FileNotFoundError:
+            return None
+        return st.st_size, st.st_mtime_ns
+
+    def refresh(self) -> list[str]:
+        """
+        Reloads the resource files that changed since they were loaded, and returns
+        their resource types
+        """
+        reloaded = []
+        for resource_type, fields in self.fields.items():
+            filepath = ndjson_path(self.data_dir, resource_type)
+            signature = self._signature(filepath)
+            if (
+                resource_type in self.resources
+                and signature == self._signatures[resource_type]
+            ):
+                continue
+            previous = self.resources.get(resource_type)
+            # A missing file means no such resources, as in `util.engine`
+            self.resources[resource_type] = (
+                []
+                if signature is None
+                else load_ndjson_cached(filepath, fields, self.cache_dir)
+            )
+            self._signatures[resource_type] = signature
+            if previous is not None:
+                drop_derived(previous)
+            reloaded.append(resource_type)
+        if reloaded:
+            # Runners hold the lists they were built with
+            self._runners.clear()
+        return reloaded
+
+    def reload(self) -> list[str]:
+        with self._lock:
+            return self.refresh()
+
+    def _get_runner(
+        self, runner_class: type[BaseRunner], start: datetime, end: datetime
+    ) -> BaseRunner:
+        key = (runner_class.__name__, start, end)
+        runner = self._runners.get(key)
+        if runner is None:
+            runner = build_runner(runner_class, start, end, self.resources)
+            self._runners[key] = runner
+            if len(self._runners) > self.max_runners:
+                self._runners.popitem(last=False)
+        else:
+            self._runners.move_to_end(key)
+        return runner
+
+    def run(
+        self,
+        names: list[str] | None = None,
+        start: datetime | None = None,
+        end: datetime | None = None,
+        with_ids: bool = False,
+    ) -> dict[str, Any]:
+        """
+        Summaries of the named measures (default all) for the period (default
+        `default_period`). Raises KeyError for an unknown measure.
+        """
+        start = start or self.default_period[0]
+        end = end or self.default_period[1]
+        runner_classes = [self.runner_classes[name] for name in names or []] or list(
+            self.runner_classes.values()
+        )
+        with self._lock:
+            self.refresh()
+            return {
+                runner_class.__name__: summarize(
+                    self._get_runner(runner_class, start, end).run_all(), with_ids
+                )
+                for runner_class in runner_classes
+            }
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: "MeasureHTTPServer"
+
+    def _reply(self, status: int, body: Any) -> None:
+        payload = json.dumps(body, indent=2).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        measures = self.server.measures
+        if url.path == "/measures":
+            self._reply(200, list(measures.runner_classes))
+        elif url.path == "/run":
+            try:
+                start, end = parse_period(query, measures.default_period)
+            except ValueError as e:
+                self._reply(400, {"error": str(e)})
+                return
+            names = query.get("measure")
+            unknown = [n for n in names or [] if n not in measures.runner_classes]
+            if unknown:
+                self._reply(404, {"error": f"Unknown measure: {unknown[0]}"})
+                return
+            began = time.perf_counter()
+            try:
+                results = measures.run(
+                    names,
+                    start,
+                    end,
+                    with_ids=query.get("ids", ["0"])[0] in ("1", "true"),
+                )
+            except Exception as e:
+                self._reply(500, {"error": f"{type(e).__name__}: {e}"})
+                return
+            self._reply(
+                200,
+                {
+                    "start": start.isoformat(),
+                    "end": end.isoformat(),
+                    "seconds": round(time.perf_counter() - began, 4),
+                    "results": results,
+                },
+            )
+        else:
+            self._reply(404, {"error": f"Unknown path: {url.path}"})
+
+    def do_POST(self) -> None:
+        if urlparse(self.path).path == "/reload":
+            self._reply(200, {"reloaded": self.server.measures.reload()})
+        else:
+            self._reply(404, {"error": f"Unknown path: {self.path}"})
+
+
+class MeasureHTTPServer(ThreadingHTTPServer):
+    """
+    HTTP front end of a `MeasureServer`
+    """
+
+    def __init__(self, address: tuple[str, int], measures: MeasureServer):
+        super().__init__(address, _Handler)
+        self.measures = measures
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from deliverables import ALL_RUNNERS
+    from main import (
+        CACHE_DIR,
+        MEASUREMENT_PERIOD_END_DATETIME,
+        MEASUREMENT_PERIOD_START_DATETIME,
+    )
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("data_dir")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    measures = MeasureServer(
+        args.data_dir,
+        ALL_RUNNERS,
+        (MEASUREMENT_PERIOD_START_DATETIME, MEASUREMENT_PERIOD_END_DATETIME),
+        cache_dir=CACHE_DIR,
+    )
+    began = time.perf_counter()
+    # Loads everything and builds the indexes the measures share
+    measures.run()
+    print(f"Warmed up in {time.perf_counter() - began:.2f}s")
+    with MeasureHTTPServer((args.host, args.port), measures) as http_server:
+        print(f"Serving on http://{args.host}:{args.port}")
+        http_server.serve_forever()
@@ -0,0 +1,233 @@
+"""
+Patient-sharded evaluation of a single measure.
+
+Every population criterion is per-patient, so patients can be partitioned by a stable
+hash of their id and each shard's resources evaluated on their own; merging is a union
+of the population sets. Shards either run in local worker processes (`run_sharded`), or
+as independent jobs over NDJSON directories pre-split with `split_ndjson_dir`:
+
+    python -m util.sharding split ../data /scratch/shards --shards 8
+    python -m util.sharding run /scratch/shards/shard-003 /scratch/out/shard-003
+    python -m util.sharding merge ./output /scratch/out/shard-*
+"""
+
+import json
+import zlib
+from datetime import datetime
+from os import listdir, makedirs, path
+from typing import AbstractSet, Any, Iterable
+
+from util.helpers import drop_derived, get_patient_id
+from util.loader import load_ndjson_file, ndjson_path, open_ndjson
+from util.parallel import run_runners
+from util.runner import STAGES, BaseRunner
+
+Resources = dict[str, list[dict[str, Any]]]
+Results = dict[str, AbstractSet[str] | None]
+
+
+def shard_of(pid: str, num_shards: int) -> int:
+    """
+    Stable shard number for a patient id (unlike `hash`, the same in every process)
+    """
+    return zlib.crc32(pid.encode()) % num_shards
+
+
+def shard_resources(resources: Resources, num_shards: int) -> list[Resources]:
+    """
+    Splits resources (keyed by resource type) so each patient's rows share one shard
+    """
+    shards: list[Resources] = [{t: [] for t in resources} for _ in range(num_shards)]
+    for resource_type, resource_list in resources.items():
+        for r in resource_list:
+            pid = get_patient_id(resource_type, r)
+            shards[shard_of(pid, num_shards)][resource_type].append(r)
+    return shards
+
+
+def build_runner(
+    runner_class: type[BaseRunner],
+    start_period: datetime,
+    end_period: datetime,
+    resources: Resources,
+) -> BaseRunner:
+    """
+    Constructs a runner, passing each declared resource type as `<type>_list`
+    """
+    lists = {
+        f"{resource_type.lower()}_list": resources.get(resource_type, [])
+        for resource_type in runner_class.RESOURCE_FIELDS
+    }
+    return runner_class(start_period, end_period, **lists)
+
+
+def merge_results(results: Iterable[Results]) -> Results:
+    """
+    Unions per-shard `run_all` results. A stage stays None only if every shard's is.
+    """
+    merged: Results = {stage: None for stage in STAGES}
+    for res in results:
+        for stage, v in res.items():
+            if v is not None:
+                merged[stage] = (merged[stage] or set()) | v
+    return merged
+
+
+def run_sharded(
+    runner_class: type[BaseRunner],
+    start_period: datetime,
+    end_period: datetime,
+    resources: Resources,
+    num_shards: int,
+    num_workers: int = 1,
+) -> Results:
+    """
+    Runs `runner_class` over `num_shards` patient shards and returns the merged results
+    """
+    shards = shard_resources(resources, num_shards)
+    runners = [
+        build_runner(runner_class, start_period, end_period, shard) for shard in shards
+    ]
+    try:
+        return merge_results(run_runners(runners, num_workers=num_workers))
+    finally:
+        for shard in shards:
+            drop_resource_indexes(shard)
+
+
+def drop_resource_indexes(resources: Resources) -> None:
+    """
+    Drops the indexes built on short-lived resource lists (see `drop_derived`)
+    """
+    for resource_list in resources.values():
+        drop_derived(resource_list)
+
+
+def split_ndjson_dir(
+    data_dir: str, out_dir: str, num_shards: int, resource_types: Iterable[str]
+) -> list[str]:
+    """
+    Writes `<out_dir>/shard-NNN/<type>.ndjson` per shard and returns the shard dirs.
+
+    Lines are copied through unchanged (compressed inputs are decompressed), so the
+    shards are regular bulk-export directories.
+    """
+    shard_dirs = [f"{out_dir}/shard-{i:03d}" for i in range(num_shards)]
+    for shard_dir in shard_dirs:
+        makedirs(shard_dir, exist_ok=True)
+    for resource_type in resource_types:
+        outputs = [open(f"{d}/{resource_type}.ndjson", "wb") for d in shard_dirs]
+        try:
+            with open_ndjson(ndjson_path(data_dir, resource_type)) as file:
+                for line in file:
+                    if line.strip():
+                        pid = get_patient_id(resource_type, json.loads(line))
+                        outputs[shard_of(pid, num_shards)].write(line)
+        finally:
+            for output in outputs:
+                output.close()
+    return shard_dirs
+
+
+def run_shard_dir(
+    runner_class: type[BaseRunner],
+    start_period: datetime,
+    end_period: datetime,
+    shard_dir: str,
+    save_to_dir: str | None = None,
+) -> Results:
+    """
+    Runs `runner_class` over one pre-split shard directory, as an independent job
+    """
+    resources = {
+        resource_type: load_ndjson_file(ndjson_path(shard_dir, resource_type), fields)
+        for resource_type, fields in runner_class.RESOURCE_FIELDS.items()
+    }
+    runner = build_runner(runner_class, start_period, end_period, resources)
+    if save_to_dir:
+        makedirs(save_to_dir, exist_ok=True)
+    try:
+        return runner.run_all(save_to_dir=save_to_dir)
+    finally:
+        drop_resource_indexes(resources)
+
+
+def read_saved_results(save_to_dir: str, runner_name: str) -> Results:
+    """
+    Reads back the files `BaseRunner.report` writes for one runner
+    """
+    res: Results = {}
+    for stage in STAGES:
+        with open(f"{save_to_dir}/{runner_name}/{stage}.json", "r") as file:
+            v = json.load(file)
+        res[stage] = set(v) if v is not None else None
+    return res
+
+
+def merge_saved_results(shard_output_dirs: list[str]) -> dict[str, Results]:
+    """
+    Merges the saved results of every runner found in the shard output directories
+    """
+    runner_names = sorted(
+        {
+            name
+            for d in shard_output_dirs
+            for name in listdir(d)
+            if path.isdir(f"{d}/{name}")
+        }
+    )
+    return {
+        name: merge_results(read_saved_results(d, name) for d in shard_output_dirs)
+        for name in runner_names
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from deliverables import ALL_RUNNERS
+    from main import MEASUREMENT_PERIOD_END_DATETIME, MEASUREMENT_PERIOD_START_DATETIME
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    split_parser = commands.add_parser("split", help="Split NDJSON files into shards")
+    split_parser.add_argument("data_dir")
+    split_parser.add_argument("out_dir")
+    split_parser.add_argument("--shards", type=int, required=True)
+    run_parser = commands.add_parser("run", help="Run every measure over one shard")
+    run_parser.add_argument("shard_dir")
+    run_parser.add_argument("save_to_dir")
+    merge_parser = commands.add_parser("merge", help="Merge saved shard results")
+    merge_parser.add_argument("save_to_dir")
+    merge_parser.add_argument("shard_output_dirs", nargs="+")
+    args = parser.parse_args()
+
+    if args.command == "split":
+        resource_types = {t for r in ALL_RUNNERS for t in r.RESOURCE_FIELDS}
+        split_ndjson_dir(
+            args.data_dir, args.out_dir, args.shards, sorted(resource_types)
+        )
+    elif args.command == "run":
+        for runner_class in ALL_RUNNERS:
+            run_shard_dir(
+                runner_class,
+                MEASUREMENT_PERIOD_START_DATETIME,
+                MEASUREMENT_PERIOD_END_DATETIME,
+                args.shard_dir,
+                save_to_dir=args.save_to_dir,
+            )
+    else:
+        merged = merge_saved_results(args.shard_output_dirs)
+        makedirs(args.save_to_dir, exist_ok=True)
+        for runner_class in ALL_RUNNERS:
+            if runner_class.__name__ in merged:
+                build_runner(
+                    runner_class,
+                    MEASUREMENT_PERIOD_START_DATETIME,
+                    MEASUREMENT_PERIOD_END_DATETIME,
+                    {},
+                ).report(
+                    merged[runner_class.__name__],
+                    print_counts=True,
+                    save_to_dir=args.save_to_dir,
+                )
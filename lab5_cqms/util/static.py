@@ -1,3 +1,8 @@
+from util.terminology import ValueSet
+
+SNOMED = "http://snomed.info/sct"
+CVX = "http://hl7.org/fhir/sid/cvx"
+
 ADVANCED_ILLNESS_SET = {
     "Chronic obstructive bronchitis (disorder)",
     "Alzheimer's disease (disorder)",
@@ -8,3 +13,8 @@ ADVANCED_ILLNESS_SET = {
     "Atrial Fibrillation",
     "Carcinoma in situ of prostate (disorder)",
 }
+
+MAMMOGRAPHY = ValueSet("Mammography", codes=[(SNOMED, "71651007")])
+INFLUENZA_VACCINE = ValueSet("Influenza Vaccine", codes=[(CVX, "140")])
+HYPERTENSION = ValueSet("Essential Hypertension", codes=[(SNOMED, "59621000")])
+ADVANCED_ILLNESS = ValueSet("Advanced Illness", displays=ADVANCED_ILLNESS_SET)
@@ -0,0 +1,391 @@
+"""
+SQLite resource store that runners can query instead of loading resource lists.
+
+The NDJSON export is ingested once into a local SQLite file:
+
+    python -m util.store ../data ./cqm.db
+
+It holds one row per patient (gender, birth date in epoch days) and one per resource
+(patient, status), plus side tables for the fields measures filter on: dated fields,
+CodeableConcept codings and Observation component values. Each side table is indexed by
+resource type, field and patient, and also by date or code. A runner given a
+`ResourceStore` instead of lists turns each criterion into one indexed query. Only
+patient ids come back into memory, never resources, so extracts far larger than RAM
+still work:
+
+    store = ResourceStore("./cqm.db")
+    CMS125v11Runner(start, end, store=store).run_all()
+
+A criterion is an SQL condition on the current patient row `p` plus its parameters (see
+`age_between` and `has_resource`), and `ResourceStore.patients_where` ANDs criteria
+into a single query. Dates and ages follow the list-based runners exactly:
+`epoch_is_within_range` windows and whole days / 365 ages.
+"""
+
+import math
+import sqlite3
+from contextlib import closing
+from os import getpid, path, remove, replace
+from typing import Any, Iterable
+from urllib.request import pathname2url
+
+from util.dates import MISSING_EPOCH, SECONDS_PER_DAY, month_of, to_epoch_seconds
+from util.helpers import compile_path, get_patient_id
+from util.loader import iter_ndjson, ndjson_path
+from util.patients import Gender, Patient
+from util.populations import PatientUniverse, PopulationSet
+from util.terminology import ValueSet
+
+# SQL condition on the patient row `p`, and its parameters
+Criterion = tuple[str, tuple[Any, ...]]
+
+RESOURCE_TYPES = (
+    "Patient",
+    "Encounter",
+    "Procedure",
+    "Immunization",
+    "Condition",
+    "Observation",
+)
+
+# Dated fields indexed per resource type
+DATE_FIELDS: dict[str, tuple[str, ...]] = {
+    "Encounter": ("period.start", "period.end"),
+    "Procedure": ("performedPeriod.start",),
+    "Immunization": ("occurrenceDateTime",),
+    "Observation": ("effectiveDateTime",),
+}
+
+# CodeableConcept fields indexed per resource type
+CONCEPT_FIELDS: dict[str, tuple[str, ...]] = {
+    "Procedure": ("code",),
+    "Immunization": ("vaccineCode",),
+    "Condition": ("code",),
+    "Observation": ("code",),
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS patients (
+    id TEXT PRIMARY KEY, gender INTEGER, birth_day INTEGER
+);
+CREATE TABLE IF NOT EXISTS resources (
+    id INTEGER PRIMARY KEY, type TEXT, patient TEXT, status TEXT
+);
+CREATE TABLE IF NOT EXISTS dates (
+    resource INTEGER, type TEXT, field TEXT, patient TEXT,
+    time INTEGER, day INTEGER, month INTEGER
+);
+CREATE TABLE IF NOT EXISTS codings (
+    resource INTEGER, type TEXT, field TEXT, patient TEXT, code TEXT, display TEXT
+);
+CREATE TABLE IF NOT EXISTS components (
+    resource INTEGER, text TEXT, value REAL
+);
+CREATE INDEX IF NOT EXISTS patients_by_birth_day ON patients (birth_day);
+CREATE INDEX IF NOT EXISTS resources_by_patient ON resources (type, patient);
+CREATE INDEX IF NOT EXISTS dates_by_patient ON dates (type, field, patient, time);
+CREATE INDEX IF NOT EXISTS dates_by_time ON dates (type, field, time);
+CREATE INDEX IF NOT EXISTS codings_by_resource ON codings (resource, field);
+CREATE INDEX IF NOT EXISTS codings_by_code ON codings (type, field, code);
+CREATE INDEX IF NOT EXISTS codings_by_display ON codings (type, field, display);
+CREATE INDEX IF NOT EXISTS components_by_resource ON components (resource, text);
+"""
+
+
+def _placeholders(values: tuple[Any, ...]) -> str:
+    return ", ".join("?" * len(values))
+
+
+def gender_is(gender: Gender) -> Criterion:
+    return "p.gender = ?", (int(gender),)
+
+
+def age_between(
+    time: int, min_age: float | None = None, max_age: float | None = None
+) -> Criterion:
+    """
+    Patient's age at `time` (epoch seconds) is within [`min_age`, `max_age`]
+    """
+    day = time // SECONDS_PER_DAY
+    conditions, params = ["1"], []
+    # Ages are whole days / 365, so age bounds are whole-day bounds on the birth day
+    if max_age is not None:
+        conditions.append("p.birth_day >= ?")
+        params.append(day - math.floor(max_age * 365))
+    if min_age is not None:
+        conditions.append("p.birth_day <= ?")
+        params.append(day - math.ceil(min_age * 365))
+    return " AND ".join(conditions), tuple(params)
+
+
+def has_resource(
+    resource_type: str,
+    date_key: str | None = None,
+    start: int | None = None,
+    end: int | None = None,
+    months: tuple[int, ...] | None = None,
+    min_age: float | None = None,
+    status: str | None = None,
+    concept_key: str | None = None,
+    value_set: ValueSet | None = None,
+) -> Criterion:
+    """
+    Patient has a resource of `resource_type` that passes every given filter:
+    - its `date_key` date is within (`start`, `end`), in `months` (read from the date
+      string) and at a patient age of at least `min_age`
+    - its status is `status`
+    - its CodeableConcept at `concept_key` is in `value_set`
+    """
+    if date_key is not None:
+        source, resource = "dates d", "d.resource"
+        conditions = ["d.type = ?", "d.field = ?", "d.patient = p.id"]
+        params: list[Any] = [resource_type, date_key]
+        if start is not None:
+            conditions.append("d.time > ?")
+            params.append(start - SECONDS_PER_DAY)
+        if end is not None:
+            conditions.append("d.time <= ?")
+            params.append(end)
+        if months is not None:
+            conditions.append(f"d.month IN ({_placeholders(months)})")
+            params.extend(months)
+        if min_age is not None:
+            conditions.append("d.day - p.birth_day >= ?")
+            params.append(math.ceil(min_age * 365))
+    else:
+        source, resource = "resources r", "r.id"
+        conditions = ["r.type = ?", "r.patient = p.id"]
+        params = [resource_type]
+    if status is not None:
+        conditions.append(
+            "EXISTS (SELECT 1 FROM resources s"
+            f" WHERE s.id = {resource} AND s.status = ?)"
+        )
+        params.append(status)
+    if value_set is not None:
+        codes = tuple(f"{system}|{code}" for system, code in value_set.codes)
+        conditions.append(
+            "EXISTS (SELECT 1 FROM codings c"
+            f" WHERE c.resource = {resource} AND c.field = ?"
+            f" AND (c.code IN ({_placeholders(codes)})"
+            f" OR c.display IN ({_placeholders(value_set.displays)})))"
+        )
+        params.extend((concept_key, *codes, *value_set.displays))
+    return (
+        f"EXISTS (SELECT 1 FROM {source} WHERE {' AND '.join(conditions)})",
+        tuple(params),
+    )
+
+
+def any_of(*criteria: Criterion) -> Criterion:
+    """
+    At least one of `criteria` holds
+    """
+    return (
+        f"({' OR '.join(sql for sql, _ in criteria)})",
+        tuple(p for _, params in criteria for p in params),
+    )
+
+
+class ResourceStore:
+    """
+    Patients and indexed resource fields in the SQLite database at `db_path`.
+
+    The database must already exist (see `build_store`). It is opened read-only unless
+    `writable`, which only ingestion needs.
+    """
+
+    def __init__(self, db_path: str, writable: bool = False):
+        if not path.isfile(db_path):
+            raise FileNotFoundError(
+                f"No resource store at {db_path}"
+                " (build one with `python -m util.store`)"
+            )
+        self.db_path = db_path
+        mode = "rw" if writable else "ro"
+        self.connection = sqlite3.connect(
+            f"file:{pathname2url(path.abspath(db_path))}?mode={mode}", uri=True
+        )
+        # Shared by every population this store returns, so they combine as bitmaps
+        self.universe = PatientUniverse()
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def ingest(self, resource_type: str, resources: Iterable[dict[str, Any]]) -> int:
+        """
+        Adds `resources` of `resource_type` and returns how many there were. Patients
+        replace any earlier patient with the same id; other resources are appended.
+        """
+        if resource_type == "Patient":
+            patients = [Patient.from_resource(r) for r in resources]
+            with self.connection:
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO patients VALUES (?, ?, ?)",
+                    ((p.id, int(p.gender), p.birth_day) for p in patients),
+                )
+            return len(patients)
+
+        date_getters = {
+            key: compile_path(key) for key in DATE_FIELDS.get(resource_type, ())
+        }
+        concept_getters = {
+            key: compile_path(key) for key in CONCEPT_FIELDS.get(resource_type, ())
+        }
+        rows: dict[str, list[tuple]] = {
+            "resources": [],
+            "dates": [],
+            "codings": [],
+            "components": [],
+        }
+        (last_id,) = self.connection.execute(
+            "SELECT COALESCE(MAX(id), 0) FROM resources"
+        ).fetchone()
+        for rid, r in enumerate(resources, last_id + 1):
+            pid = get_patient_id(resource_type, r)
+            rows["resources"].append((rid, resource_type, pid, r.get("status")))
+            for key, get_date in date_getters.items():
+                date = get_date(r)
+                time = to_epoch_seconds(date)
+                if time != MISSING_EPOCH:
+                    # Months are read from the date string, as in `get_monthly_timeline`
+                    month = month_of(date)
+                    rows["dates"].append(
+                        (
+                            rid,
+                            resource_type,
+                            key,
+                            pid,
+                            time,
+                            time // SECONDS_PER_DAY,
+                            month,
+                        )
+                    )
+            for key, get_concept in concept_getters.items():
+                for coding in (get_concept(r) or {}).get("coding") or []:
+                    code = coding.get("code")
+                    rows["codings"].append(
+                        (
+                            rid,
+                            resource_type,
+                            key,
+                            pid,
+                            None if code is None else f"{coding.get('system')}|{code}",
+                            coding.get("display"),
+                        )
+                    )
+            if resource_type == "Observation":
+                # Last component with a given text wins, as in `get_component_column`
+                values = {}
+                for c in r.get("component") or []:
+                    values[(c.get("code") or {}).get("text")] = (
+                        c.get("valueQuantity") or {}
+                    ).get("value")
+                rows["components"].extend(
+                    (rid, text, float(value))
+                    for text, value in values.items()
+                    if text is not None and value is not None
+                )
+        with self.connection:
+            for table, table_rows in rows.items():
+                if table_rows:
+                    self.connection.executemany(
+                        f"INSERT INTO {table} VALUES"
+                        f" ({_placeholders(table_rows[0])})",
+                        table_rows,
+                    )
+        return len(rows["resources"])
+
+    def ingest_ndjson_dir(
+        self, data_dir: str, batch_size: int = 50_000
+    ) -> dict[str, int]:
+        """
+        Streams every `<data_dir>/<type>.ndjson` (or `.ndjson.gz` / `.zst`) of
+        `RESOURCE_TYPES` into the store, `batch_size` resources per transaction. Types
+        without a file are skipped.
+        """
+        ingested = {}
+        for resource_type in RESOURCE_TYPES:
+            filepath = ndjson_path(data_dir, resource_type)
+            ingested[resource_type] = 0
+            if not path.exists(filepath):
+                continue
+            batch = []
+            for r in iter_ndjson(filepath):
+                batch.append(r)
+                if len(batch) == batch_size:
+                    ingested[resource_type] += self.ingest(resource_type, batch)
+                    batch = []
+            ingested[resource_type] += self.ingest(resource_type, batch)
+        self.connection.execute("ANALYZE")
+        return ingested
+
+    def population(self, ids: Iterable[str]) -> PopulationSet:
+        return PopulationSet.from_ids(self.universe, ids)
+
+    def patients_where(self, *criteria: Criterion) -> PopulationSet:
+        """
+        Patients meeting every one of `criteria`, as one query
+        """
+        conditions = " AND ".join(sql for sql, _ in criteria) or "1"
+        params = tuple(p for _, params in criteria for p in params)
+        cursor = self.connection.execute(
+            f"SELECT p.id FROM patients p WHERE {conditions}", params
+        )
+        return self.population(pid for (pid,) in cursor)
+
+    def latest_readings(
+        self,
+        components: tuple[str, ...],
+        start: int,
+        end: int,
+        date_key: str = "effectiveDateTime",
+    ) -> dict[str, tuple[float, ...]]:
+        """
+        Values of `components` in each patient's latest Observation within (`start`,
+        `end`) that has all of them (see `util.observations.get_reading_timeline`).
+        Readings at the same time are ordered as they were ingested.
+        """
+        joins = "".join(
+            f" JOIN components c{i} ON c{i}.resource = d.resource AND c{i}.text = ?"
+            for i in range(len(components))
+        )
+        columns = ", ".join(f"c{i}.value" for i in range(len(components)))
+        cursor = self.connection.execute(
+            f"SELECT * FROM (SELECT d.patient, {columns}, ROW_NUMBER() OVER"
+            " (PARTITION BY d.patient ORDER BY d.time DESC, d.resource DESC) AS n"
+            f" FROM dates d{joins}"
+            " WHERE d.type = 'Observation' AND d.field = ? AND d.time > ?"
+            " AND d.time <= ?) WHERE n = 1",
+            (*components, date_key, start - SECONDS_PER_DAY, end),
+        )
+        return {pid: tuple(values) for pid, *values, _ in cursor}
+
+
+def build_store(data_dir: str, db_path: str) -> dict[str, int]:
+    """
+    (Re)builds the store at `db_path` from `data_dir`, replacing it only once complete
+    """
+    tmp_path = f"{db_path}.{getpid()}.tmp"
+    if path.exists(tmp_path):
+        remove(tmp_path)
+    with closing(sqlite3.connect(tmp_path)) as connection:
+        connection.executescript(SCHEMA)
+    store = ResourceStore(tmp_path, writable=True)
+    try:
+        ingested = store.ingest_ndjson_dir(data_dir)
+    finally:
+        store.close()
+    replace(tmp_path, db_path)
+    return ingested
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("data_dir")
+    parser.add_argument("db_path")
+    args = parser.parse_args()
+    for resource_type, n in build_store(args.data_dir, args.db_path).items():
+        print(f"{resource_type}: {n}")
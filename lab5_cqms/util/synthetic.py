@@ -0,0 +1,272 @@
+"""
+Synthetic FHIR population generator for benchmarking.
+
+Writes Synthea-shaped Patient, Encounter, Procedure, Immunization, Condition and
+Observation NDJSON files with realistic per-patient resource counts, including the codes
+the measures look for (mammograms, flu shots, hypertension, advanced illness and BP
+panels). Output is streamed patient by patient, so a million patients need little
+memory.
+"""
+
+import json
+import random
+import uuid
+from datetime import datetime, timedelta, timezone
+from os import makedirs
+from typing import Any
+
+RESOURCE_TYPES = (
+    "Patient",
+    "Encounter",
+    "Procedure",
+    "Immunization",
+    "Condition",
+    "Observation",
+)
+
+SNOMED = "http://snomed.info/sct"
+LOINC = "http://loinc.org"
+CVX = "http://hl7.org/fhir/sid/cvx"
+
+OTHER_PROCEDURES = [
+    ("430193006", "Medication Reconciliation (procedure)"),
+    ("710824005", "Assessment of health and social care needs (procedure)"),
+    ("171207006", "Depression screening (procedure)"),
+    ("428211000124100", "Assessment of substance use (procedure)"),
+]
+OTHER_VACCINES = [
+    ("113", "Td (adult) preservative free"),
+    ("133", "Pneumococcal conjugate PCV 13"),
+    ("08", "Hep B, adolescent or pediatric"),
+]
+ADVANCED_ILLNESSES = [
+    ("185086009", "Chronic obstructive bronchitis (disorder)"),
+    ("26929004", "Alzheimer's disease (disorder)"),
+    ("254837009", "Malignant neoplasm of breast (disorder)"),
+    ("275272006", "Brain damage - traumatic"),
+    ("53741008", "Coronary Heart Disease"),
+    ("230690007", "Stroke"),
+    ("49436004", "Atrial Fibrillation"),
+    ("92691004", "Carcinoma in situ of prostate (disorder)"),
+]
+OTHER_CONDITIONS = [
+    ("40055000", "Chronic sinusitis (disorder)"),
+    ("15777000", "Prediabetes"),
+    ("444814009", "Viral sinusitis (disorder)"),
+    ("162864005", "Body mass index 30+ - obesity (finding)"),
+]
+
+# Mean encounters per patient, roughly matching the Synthea sample in data/
+MEAN_ENCOUNTERS = 37
+
+
+def _timestamp(dt: datetime) -> str:
+    offset = "-04:00" if 4 <= dt.month <= 10 else "-05:00"
+    return dt.strftime("%Y-%m-%dT%H:%M:%S") + offset
+
+
+def _coding(system: str, code: str, display: str) -> dict[str, Any]:
+    return {
+        "coding": [{"system": system, "code": code, "display": display}],
+        "text": display,
+    }
+
+
+class _PatientGenerator:
+    def __init__(self, rng: random.Random):
+        self.rng = rng
+        self.pid = self._id()
+        self.gender = rng.choice(("female", "male"))
+        self.birth = datetime(1930, 1, 1, tzinfo=timezone.utc) + timedelta(
+            days=rng.randrange(0, 90 * 365)
+        )
+        self.subject = {"reference": f"Patient/{self.pid}"}
+
+    def _id(self) -> str:
+        return str(uuid.UUID(int=self.rng.getrandbits(128), version=4))
+
+    def _age_at(self, dt: datetime) -> float:
+        return (dt - self.birth).days / 365.0
+
+    def patient(self) -> dict[str, Any]:
+        return {
+            "resourceType": "Patient",
+            "id": self.pid,
+            "gender": self.gender,
+            "birthDate": self.birth.strftime("%Y-%m-%d"),
+        }
+
+    def encounter_dates(self) -> list[datetime]:
+        first = max(self.birth, datetime(2005, 1, 1, tzinfo=timezone.utc))
+        span = (datetime(2023, 1, 1, tzinfo=timezone.utc) - first).days
+        if span <= 0:
+            return []
+        count = max(1, int(self.rng.expovariate(1 / MEAN_ENCOUNTERS)))
+        return sorted(
+            first
+            + timedelta(
+                days=self.rng.randrange(span), seconds=self.rng.randrange(86400)
+            )
+            for _ in range(count)
+        )
+
+    def encounter(self, start: datetime) -> dict[str, Any]:
+        end = start + timedelta(minutes=self.rng.choice((15, 30, 45, 60)))
+        return {
+            "resourceType": "Encounter",
+            "id": self._id(),
+            "status": "finished",
+            "class": {"code": "AMB"},
+            "type": [
+                _coding(SNOMED, "185349003", "Encounter for check up (procedure)")
+            ],
+            "subject": self.subject,
+            "period": {"start": _timestamp(start), "end": _timestamp(end)},
+        }
+
+    def procedure(self, start: datetime) -> dict[str, Any]:
+        if (
+            self.gender == "female"
+            and self._age_at(start) >= 40
+            and self.rng.random() < 0.3
+        ):
+            code, display = "71651007", "Mammography (procedure)"
+        else:
+            code, display = self.rng.choice(OTHER_PROCEDURES)
+        end = start + timedelta(minutes=15)
+        return {
+            "resourceType": "Procedure",
+            "id": self._id(),
+            "status": "completed" if self.rng.random() < 0.95 else "in-progress",
+            "code": _coding(SNOMED, code, display),
+            "subject": self.subject,
+            "performedPeriod": {"start": _timestamp(start), "end": _timestamp(end)},
+        }
+
+    def immunization(self, start: datetime, flu: bool) -> dict[str, Any]:
+        if flu:
+            code, display = "140", "Influenza, seasonal, injectable, preservative free"
+        else:
+            code, display = self.rng.choice(OTHER_VACCINES)
+        return {
+            "resourceType": "Immunization",
+            "id": self._id(),
+            "status": "completed" if self.rng.random() < 0.97 else "not-done",
+            "vaccineCode": _coding(CVX, code, display),
+            "patient": self.subject,
+            "occurrenceDateTime": _timestamp(start),
+            "primarySource": True,
+        }
+
+    def condition(self, start: datetime, code: str, display: str) -> dict[str, Any]:
+        return {
+            "resourceType": "Condition",
+            "id": self._id(),
+            "clinicalStatus": _coding(
+                "http://terminology.hl7.org/CodeSystem/condition-clinical",
+                "active",
+                "Active",
+            ),
+            "code": _coding(SNOMED, code, display),
+            "subject": self.subject,
+            "onsetDateTime": _timestamp(start),
+            "recordedDate": _timestamp(start),
+        }
+
+    def blood_pressure(self, start: datetime, hypertensive: bool) -> dict[str, Any]:
+        systolic = self.rng.gauss(145 if hypertensive else 120, 12)
+        diastolic = self.rng.gauss(92 if hypertensive else 78, 8)
+        return {
+            "resourceType": "Observation",
+            "id": self._id(),
+            "status": "final",
+            "code": _coding(
+                LOINC, "85354-9", "Blood pressure panel with all children optional"
+            ),
+            "subject": self.subject,
+            "effectiveDateTime": _timestamp(start),
+            "component": [
+                {
+                    "code": _coding(LOINC, "8462-4", "Diastolic Blood Pressure"),
+                    "valueQuantity": {"value": round(diastolic), "unit": "mm[Hg]"},
+                },
+                {
+                    "code": _coding(LOINC, "8480-6", "Systolic Blood Pressure"),
+                    "valueQuantity": {"value": round(systolic), "unit": "mm[Hg]"},
+                },
+            ],
+        }
+
+    def body_height(self, start: datetime) -> dict[str, Any]:
+        return {
+            "resourceType": "Observation",
+            "id": self._id(),
+            "status": "final",
+            "code": _coding(LOINC, "8302-2", "Body Height"),
+            "subject": self.subject,
+            "effectiveDateTime": _timestamp(start),
+            "valueQuantity": {"value": round(self.rng.gauss(170, 10), 1), "unit": "cm"},
+        }
+
+    def resources(self) -> dict[str, list[dict[str, Any]]]:
+        rng = self.rng
+        res: dict[str, list[dict[str, Any]]] = {t: [] for t in RESOURCE_TYPES}
+        res["Patient"].append(self.patient())
+        dates = self.encounter_dates()
+        hypertensive = False
+        flu_seasons = set()
+        for i, start in enumerate(dates):
+            age = self._age_at(start)
+            res["Encounter"].append(self.encounter(start))
+            if rng.random() < 0.45:
+                res["Procedure"].append(self.procedure(start))
+            season = start.year if start.month >= 8 else start.year - 1
+            if age >= 0.5 and season not in flu_seasons and rng.random() < 0.7:
+                flu_seasons.add(season)
+                res["Immunization"].append(self.immunization(start, flu=True))
+            elif rng.random() < 0.05:
+                res["Immunization"].append(self.immunization(start, flu=False))
+            if not hypertensive and age >= 18 and rng.random() < 0.02:
+                hypertensive = True
+                res["Condition"].append(
+                    self.condition(start, "59621000", "Hypertension")
+                )
+            if age >= 60 and rng.random() < 0.01:
+                res["Condition"].append(
+                    self.condition(start, *rng.choice(ADVANCED_ILLNESSES))
+                )
+            if rng.random() < 0.08:
+                res["Condition"].append(
+                    self.condition(start, *rng.choice(OTHER_CONDITIONS))
+                )
+            if age >= 3 and rng.random() < 0.5:
+                res["Observation"].append(self.blood_pressure(start, hypertensive))
+            if i % 4 == 0:
+                res["Observation"].append(self.body_height(start))
+        return res
+
+
+def generate_dataset(out_dir: str, num_patients: int, seed: int = 0) -> dict[str, int]:
+    """
+    Writes `<out_dir>/<type>.ndjson` for `num_patients` patients.
+
+    Returns the number of resources written per type. The same seed always produces the
+    same files.
+    """
+    makedirs(out_dir, exist_ok=True)
+    rng = random.Random(seed)
+    counts = {t: 0 for t in RESOURCE_TYPES}
+    files = {t: open(f"{out_dir}/{t}.ndjson", "w") for t in RESOURCE_TYPES}
+    try:
+        for _ in range(num_patients):
+            for resource_type, resource_list in (
+                _PatientGenerator(rng).resources().items()
+            ):
+                for r in resource_list:
+                    files[resource_type].write(json.dumps(r, separators=(",", ":")))
+                    files[resource_type].write("\n")
+                counts[resource_type] += len(resource_list)
+    finally:
+        for file in files.values():
+            file.close()
+    return counts
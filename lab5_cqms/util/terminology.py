@@ -0,0 +1,119 @@
+"""
+Value sets and a shared membership index for coded values.
+
+A `ValueSet` lists (system, code) pairs plus display-text aliases. Every value set
+registered with a `Terminology` gets one bit, and each interned system+code / display id
+maps to the bits of every value set containing it. Matching a CodeableConcept therefore
+walks all of its `coding` entries once and yields the bits of every value set it belongs
+to, however many value sets (and measures) there are. Per resource list, those bits are
+computed once per concept field (`get_value_set_column`) and then tested as plain ints,
+which grow with the number of value sets rather than capping it.
+"""
+
+from typing import Any, Iterable
+
+from util.columns import Interner
+from util.helpers import compile_path, get_derived
+from util.instrument import count
+
+
+class Terminology:
+    """
+    Interned membership index over every registered value set
+    """
+
+    def __init__(self) -> None:
+        self.value_sets: list["ValueSet"] = []
+        self.codes = Interner()
+        self.displays = Interner()
+        self._code_bits: dict[int, int] = {}
+        self._display_bits: dict[int, int] = {}
+
+    def register(self, value_set: "ValueSet") -> int:
+        """
+        Adds `value_set` to the index and returns its bit
+        """
+        bit = 1 << len(self.value_sets)
+        self.value_sets.append(value_set)
+        for system, code in value_set.codes:
+            code_id = self.codes.intern(f"{system}|{code}")
+            self._code_bits[code_id] = self._code_bits.get(code_id, 0) | bit
+        for display in value_set.displays:
+            display_id = self.displays.intern(display)
+            self._display_bits[display_id] = self._display_bits.get(display_id, 0) | bit
+        return bit
+
+    def concept_bits(self, concept: dict[str, Any] | None) -> int:
+        """
+        Returns the bits of every value set matching any `coding` of `concept`
+        """
+        bits = 0
+        if not concept:
+            return bits
+        for coding in concept.get("coding") or []:
+            code = coding.get("code")
+            if code is not None:
+                code_id = self.codes.lookup(f"{coding.get('system')}|{code}")
+                bits |= self._code_bits.get(code_id, 0)
+            display = coding.get("display")
+            if display is not None:
+                bits |= self._display_bits.get(self.displays.lookup(display), 0)
+        return bits
+
+
+# Every value set registers here, so one mask per concept covers all of them
+TERMINOLOGY = Terminology()
+
+
+class ValueSet:
+    """
+    Named set of (system, code) pairs and display aliases, matched on any `coding`
+    """
+
+    def __init__(
+        self,
+        name: str,
+        codes: Iterable[tuple[str, str]] = (),
+        displays: Iterable[str] = (),
+    ):
+        self.name = name
+        self.codes = tuple(codes)
+        self.displays = tuple(displays)
+        self.bit = TERMINOLOGY.register(self)
+
+    def __repr__(self) -> str:
+        return f"ValueSet({self.name!r})"
+
+    def matches(self, concept: dict[str, Any] | None) -> bool:
+        return bool(TERMINOLOGY.concept_bits(concept) & self.bit)
+
+
+def get_value_set_column(
+    resource_list: list[dict[str, Any]], concept_key: str
+) -> list[int]:
+    """
+    Returns the (shared) value set bits of the CodeableConcept at `concept_key`, per
+    resource.
+
+    Rebuilt if value sets were registered since, so the bits always cover all of them.
+    """
+    return get_derived(
+        resource_list,
+        f"value_sets:{concept_key}:{len(TERMINOLOGY.value_sets)}",
+        lambda rl: list(
+            map(TERMINOLOGY.concept_bits, map(compile_path(concept_key), rl))
+        ),
+    )
+
+
+def value_set_mask(
+    resource_list: list[dict[str, Any]], concept_key: str, value_set: ValueSet
+) -> bytearray:
+    """
+    Rows whose CodeableConcept at `concept_key` is in `value_set`, as a byte mask (see
+    `util.columns.ResourceColumns.patients_where`)
+    """
+    bit = value_set.bit
+    column = get_value_set_column(resource_list, concept_key)
+    count(scanned=len(column), predicates=len(column))
+    return bytearray(bool(bits & bit) for bits in column)
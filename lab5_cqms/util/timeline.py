@@ -0,0 +1,193 @@
+"""
+Per-patient event timelines for window queries.
+
+Each patient's event times (epoch seconds) are kept sorted, so whether a patient has an
+event in a measurement period is a bisect rather than a rescan of their resources.
+`PatientTimelines` is filled one event at a time (see `util.engine`), while
+`TimelineIndex` is the compact, read-only form built once per loaded resource list.
+Window bounds follow `epoch_is_within_range`: an event at `t` is within (start, end)
+iff `start - 1 day < t <= end`.
+"""
+
+from array import array
+from bisect import bisect_left, bisect_right
+from typing import Any, Iterable
+
+from util.dates import MISSING_EPOCH, SECONDS_PER_DAY, month_of
+from util.helpers import compile_path, get_date_column, get_derived, get_patient_index
+
+
+class PatientTimelines:
+    """
+    Sorted event times per patient id, with the value given for each event
+    """
+
+    def __init__(self) -> None:
+        self.times: dict[str, list[int]] = {}
+        self.values: dict[str, list[Any]] = {}
+
+    def add(self, pid: str, time: int, value: Any = None) -> None:
+        """
+        Records an event; events without a date (`MISSING_EPOCH`) are ignored
+        """
+        if time == MISSING_EPOCH:
+            return
+        times = self.times.setdefault(pid, [])
+        values = self.values.setdefault(pid, [])
+        # Resources mostly arrive in date order, so this is usually an append. Events at
+        # the same time keep their arrival order.
+        if not times or times[-1] <= time:
+            times.append(time)
+            values.append(value)
+        else:
+            i = bisect_right(times, time)
+            times.insert(i, time)
+            values.insert(i, value)
+
+    def _window(self, pid: str, start: int, end: int) -> tuple[int, int]:
+        times = self.times.get(pid, [])
+        return bisect_right(times, start - SECONDS_PER_DAY), bisect_right(times, end)
+
+    def any_within(self, pid: str, start: int, end: int) -> bool:
+        lo, hi = self._window(pid, start, end)
+        return lo < hi
+
+    def latest_within(self, pid: str, start: int, end: int) -> int | None:
+        """
+        Time of the patient's last event within the window, if any
+        """
+        lo, hi = self._window(pid, start, end)
+        return self.times[pid][hi - 1] if lo < hi else None
+
+    def values_within(self, pid: str, start: int, end: int) -> list[Any]:
+        """
+        Values of the patient's events within the window, in time order
+        """
+        lo, hi = self._window(pid, start, end)
+        return self.values[pid][lo:hi] if lo < hi else []
+
+    def patients_within(self, start: int, end: int) -> set[str]:
+        """
+        Ids of every patient with at least one event within the window
+        """
+        return {pid for pid in self.times if self.any_within(pid, start, end)}
+
+
+class TimelineIndex:
+    """
+    Every patient's events sorted by time and packed into arrays, one slice per patient.
+
+    `rows` holds the position of each event's resource in the list the index was built
+    from; events at the same time stay in list order.
+    """
+
+    def __init__(self, dates: array, patient_rows: Iterable[tuple[str, Iterable[int]]]):
+        self.times = array("q")
+        self.rows = array("q")
+        self.spans: dict[str, tuple[int, int]] = {}
+        for pid, rows in patient_rows:
+            rows = sorted(
+                (i for i in rows if dates[i] != MISSING_EPOCH), key=dates.__getitem__
+            )
+            if rows:
+                lo = len(self.rows)
+                self.rows.extend(rows)
+                self.times.extend(dates[i] for i in rows)
+                self.spans[pid] = (lo, len(self.rows))
+
+    def _window(self, pid: str, start: int, end: int) -> tuple[int, int]:
+        lo, hi = self.spans.get(pid, (0, 0))
+        return (
+            bisect_right(self.times, start - SECONDS_PER_DAY, lo, hi),
+            bisect_right(self.times, end, lo, hi),
+        )
+
+    def any_within(self, pid: str, start: int, end: int) -> bool:
+        lo, hi = self._window(pid, start, end)
+        return lo < hi
+
+    def latest_within(self, pid: str, start: int, end: int) -> int | None:
+        """
+        Time of the patient's last event within the window, if any
+        """
+        lo, hi = self._window(pid, start, end)
+        return self.times[hi - 1] if lo < hi else None
+
+    def latest_row_within(self, pid: str, start: int, end: int) -> int | None:
+        """
+        List position of the patient's last event within the window, if any
+        """
+        lo, hi = self._window(pid, start, end)
+        return self.rows[hi - 1] if lo < hi else None
+
+    def latest_before(self, pid: str, time: int) -> int | None:
+        """
+        Time of the patient's last event strictly before `time`, if any
+        """
+        lo, hi = self.spans.get(pid, (0, 0))
+        i = bisect_left(self.times, time, lo, hi)
+        return self.times[i - 1] if i > lo else None
+
+
+class MonthlyTimelineIndex:
+    """
+    A `TimelineIndex` per calendar month, for "any event in these months" queries
+    """
+
+    def __init__(self, dates: array, month_rows: dict[int, dict[str, list[int]]]):
+        self.months = {
+            month: TimelineIndex(dates, patient_rows.items())
+            for month, patient_rows in month_rows.items()
+        }
+
+    def any_within(self, pid: str, months: Iterable[int], start: int, end: int) -> bool:
+        return any(
+            self.months[month].any_within(pid, start, end)
+            for month in months
+            if month in self.months
+        )
+
+
+def get_timeline(
+    resource_list: list[dict[str, Any]],
+    key: str,
+    pid_reference_key: str = "subject.reference",
+) -> TimelineIndex:
+    """
+    Returns the (shared) per-patient timeline of the dates at `key`
+    """
+    return get_derived(
+        resource_list,
+        f"timeline:{key}:{pid_reference_key}",
+        lambda rl: TimelineIndex(
+            get_date_column(rl, key), get_patient_index(rl, pid_reference_key).items()
+        ),
+    )
+
+
+def get_monthly_timeline(
+    resource_list: list[dict[str, Any]],
+    key: str,
+    pid_reference_key: str = "subject.reference",
+) -> MonthlyTimelineIndex:
+    """
+    Returns the (shared) per-patient, per-month timeline of the dates at `key`.
+
+    Months are read from the date strings themselves (i.e. in their own UTC offset),
+    matching how the measures split them.
+    """
+
+    def build(rl: list[dict[str, Any]]) -> MonthlyTimelineIndex:
+        get_date = compile_path(key)
+        dates = get_date_column(rl, key)
+        month_rows: dict[int, dict[str, list[int]]] = {}
+        for pid, rows in get_patient_index(rl, pid_reference_key).items():
+            for i in rows:
+                if dates[i] != MISSING_EPOCH:
+                    month = month_of(get_date(rl[i]))
+                    month_rows.setdefault(month, {}).setdefault(pid, []).append(i)
+        return MonthlyTimelineIndex(dates, month_rows)
+
+    return get_derived(
+        resource_list, f"monthly_timeline:{key}:{pid_reference_key}", build
+    )